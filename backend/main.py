@@ -1,23 +1,57 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import os
+# OpenMP reads this once, when torch first loads; some container runtimes default it to 1
+os.environ.setdefault("OMP_NUM_THREADS", str(os.cpu_count() or 1))
+
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Response, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydub import AudioSegment
 import speech_recognition as sr
+import asyncio
 import io
+import hashlib
+import hmac
+import shutil
 import time
+import wave
+import atexit
+import logging
+import logging.handlers
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import jwt
+from cachetools import TTLCache
 from datetime import datetime, timedelta
 from typing import Optional
 from rag.chatbot import answer_query as generate_answer
-from rag.db import init_db, get_machines
-import os
+from rag.db import init_db, close_pool, get_machines, insert_note_text, set_note_embedding, delete_note
+from rag.vector_store import generate_embedding, add_note_to_bm25
 from pydantic import BaseModel
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+
+def setup_logging(level=logging.INFO):
+    """Route all logging through a queue so stream I/O happens on a listener thread, not in handlers."""
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    atexit.register(listener.stop)
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
 # Load credentials from environment variables
 AUTH_USERS = {
     os.getenv("AUTH_USERNAME_1", "user1"): os.getenv("AUTH_PASSWORD_1", "pass1"),
@@ -25,10 +59,47 @@ AUTH_USERS = {
     os.getenv("AUTH_USERNAME_3", "user3"): os.getenv("AUTH_PASSWORD_3", "pass3"),
     os.getenv("AUTH_USERNAME_4", "user4"): os.getenv("AUTH_PASSWORD_4", "pass4")
 }
+# Passwords are only kept as salted hashes and compared in constant time
+_PASSWORD_SALT = os.urandom(16)
+
+def _hash_password(password: str) -> bytes:
+    return hashlib.sha256(_PASSWORD_SALT + password.encode()).digest()
+
+AUTH_USERS_HASHED = {u: _hash_password(p) for u, p in AUTH_USERS.items()}
+_DUMMY_PASSWORD_HASH = _hash_password(os.urandom(16).hex())
+
 JWT_SECRET = os.getenv("JWT_SECRET_KEY", "default-secret-change-in-production")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
-app = FastAPI()
+
+# Verified tokens: sha256(token) -> (username, exp). Failed verifications are never cached.
+_token_cache = TTLCache(maxsize=10000, ttl=60)
+_token_cache_lock = threading.Lock()
+
+# Audio decoding: one ffmpeg pass straight to 16kHz mono s16le PCM
+AUDIO_SAMPLE_RATE = 16000
+AUDIO_SAMPLE_WIDTH = 2
+PCM_BYTES_PER_MS = AUDIO_SAMPLE_RATE * AUDIO_SAMPLE_WIDTH // 1000
+MAX_AUDIO_BYTES = 25 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+FFMPEG_PATH = shutil.which("ffmpeg")
+FFMPEG_DECODE_ARGS = [
+    "-hide_banner", "-loglevel", "error",
+    "-i", "pipe:0",
+    "-f", "s16le", "-ar", str(AUDIO_SAMPLE_RATE), "-ac", "1", "-acodec", "pcm_s16le",
+    "pipe:1",
+]
+
+# Clips shorter than this skip the ambient-noise calibration pass
+AMBIENT_NOISE_MIN_MS = 2000
+AMBIENT_NOISE_SECONDS = 0.3
+DEFAULT_ENERGY_THRESHOLD = 300
+STT_TIMEOUT_SECONDS = 15
+
+# Default executor size for blocking work dispatched with asyncio.to_thread
+THREAD_POOL_WORKERS = int(os.getenv("THREAD_POOL_WORKERS", 16))
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -41,11 +112,18 @@ app.add_middleware(
 @app.on_event("startup")
 def on_startup():
     """Initialize database tables on startup."""
+    # Larger default pool so concurrent transcriptions (asyncio.to_thread) don't queue
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=THREAD_POOL_WORKERS))
     try:
         init_db()
-        print("Database initialized on startup")
+        logger.info("Database initialized on startup")
     except Exception as e:
-        print(f"Warning: DB init on startup failed: {e}")
+        logger.warning("DB init on startup failed: %s", e)
+
+@app.on_event("shutdown")
+def on_shutdown():
+    """Release pooled database connections."""
+    close_pool()
 
 security = HTTPBearer()
 
@@ -69,18 +147,147 @@ def create_access_token(username: str):
 
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
     """Verify JWT token from Authorization header."""
+    token = credentials.credentials
+    cache_key = hashlib.sha256(token.encode()).digest()
+    with _token_cache_lock:
+        cached = _token_cache.get(cache_key)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         username: str = payload.get("sub")
         if username is None or username not in AUTH_USERS:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
+        exp = payload.get("exp")
+        if exp is not None:
+            with _token_cache_lock:
+                _token_cache[cache_key] = (username, exp)
         return username
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
 
+async def read_upload(file: UploadFile) -> bytes:
+    """Read an upload in chunks, failing fast once it exceeds MAX_AUDIO_BYTES."""
+    buf = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        buf += chunk
+        if len(buf) > MAX_AUDIO_BYTES:
+            raise HTTPException(status_code=413, detail="Audio too large")
+    return bytes(buf)
+
+def decode_with_pydub(raw: bytes) -> bytes:
+    """Decode with pydub; used only when no ffmpeg binary is available."""
+    audio = AudioSegment.from_file(io.BytesIO(raw))
+    audio = audio.set_frame_rate(AUDIO_SAMPLE_RATE).set_channels(1).set_sample_width(AUDIO_SAMPLE_WIDTH)
+    return audio.raw_data
+
+async def decode_upload(file: UploadFile):
+    """
+    Decode an uploaded recording to 16kHz mono s16le PCM.
+    The upload is already spooled to a temp file by multipart parsing; chunks are piped
+    from it into ffmpeg so the recording is never held in memory as one bytes object.
+    Returns (pcm, upload_size).
+    """
+    # Multipart parsing already knows the size; refuse giant uploads before any decode work
+    if file.size is not None and file.size > MAX_AUDIO_BYTES:
+        raise HTTPException(status_code=413, detail="Audio too large")
+
+    if not FFMPEG_PATH:
+        # ffmpeg binary not on PATH: fall back to pydub
+        raw = await read_upload(file)
+        if not raw:
+            return b"", 0
+        return await asyncio.to_thread(decode_with_pydub, raw), len(raw)
+
+    proc = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, *FFMPEG_DECODE_ARGS,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    # Drain ffmpeg's output concurrently so neither pipe can fill up and stall
+    stdout_task = asyncio.create_task(proc.stdout.read())
+    stderr_task = asyncio.create_task(proc.stderr.read())
+
+    size = 0
+    try:
+        try:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_AUDIO_BYTES:
+                    raise HTTPException(status_code=413, detail="Audio too large")
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+            proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg gave up on the input early; its stderr says why
+        pcm = await stdout_task
+        err = await stderr_task
+        await proc.wait()
+    except BaseException:
+        stdout_task.cancel()
+        stderr_task.cancel()
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+
+    if size == 0:
+        return b"", 0
+    if proc.returncode != 0 or not pcm:
+        raise RuntimeError(err.decode(errors="replace").strip() or "ffmpeg produced no audio")
+    return pcm, size
+
+def pcm_to_wav(pcm: bytes) -> io.BytesIO:
+    """Wrap raw PCM in a WAV header so speech_recognition can read it."""
+    wav_buf = io.BytesIO()
+    with wave.open(wav_buf, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(AUDIO_SAMPLE_WIDTH)
+        wav.setframerate(AUDIO_SAMPLE_RATE)
+        wav.writeframes(pcm)
+    wav_buf.seek(0)
+    return wav_buf
+
+def do_transcribe(pcm: bytes, duration_ms: int) -> dict:
+    """Run speech recognition on decoded PCM. Blocking; called via asyncio.to_thread."""
+    wav_buf = pcm_to_wav(pcm)
+
+    # Transcribe using Google Speech Recognition
+    recognizer = sr.Recognizer()
+    # Bound the sync HTTP call so a slow API can't pin a pool thread indefinitely
+    recognizer.operation_timeout = STT_TIMEOUT_SECONDS
+
+    # Adjust for ambient noise and energy threshold
+    with sr.AudioFile(wav_buf) as source:
+        if duration_ms >= AMBIENT_NOISE_MIN_MS:
+            # Adjust for background noise
+            recognizer.adjust_for_ambient_noise(source, duration=AMBIENT_NOISE_SECONDS)
+        else:
+            # Short push-to-talk clip: calibrating would eat a big share of the speech
+            recognizer.energy_threshold = DEFAULT_ENERGY_THRESHOLD
+        audio_data = recognizer.record(source)
+
+    try:
+        logger.info("Attempting transcription")
+        text = recognizer.recognize_google(audio_data, language="en-US")
+        logger.info("Transcribed: %s", text)
+        return {"text": text}
+
+    except sr.UnknownValueError:
+        logger.info("Could not understand audio")
+        return {"text": "", "error": "Could not understand audio. Please speak clearly and try again."}
+
+    except sr.RequestError as e:
+        logger.error("Speech API error: %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail=f"Speech recognition service error: {str(e)}"
+        )
+
 @app.get("/")
 def root():
     return {"status": "ok"}
@@ -99,7 +306,9 @@ async def login(request: LoginRequest):
     username = request.username
     password = request.password
 
-    if username not in AUTH_USERS or AUTH_USERS[username] != password:
+    stored = AUTH_USERS_HASHED.get(username, _DUMMY_PASSWORD_HASH)
+    password_ok = hmac.compare_digest(stored, _hash_password(password))
+    if not (password_ok and username in AUTH_USERS_HASHED):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid username or password")
     
     access_token = create_access_token(username=username)
@@ -112,93 +321,35 @@ async def transcribe_audio(file: UploadFile = File(...),
     Accepts WebM (Chrome/Firefox), MP4 (Safari), or MP3 recordings and transcribes.
     """
     try:
-        raw = await file.read()
-        if len(raw) == 0:
+        # Decode to 16kHz mono PCM (container is autodetected from the stream)
+        try:
+            pcm, upload_size = await decode_upload(file)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Could not decode audio: {str(e)}")
+
+        if upload_size == 0:
             raise HTTPException(status_code=400, detail="Empty audio file received")
 
-        # Detect format from content-type and filename
-        content_type = file.content_type or ""
-        file_ext = file.filename.split(".")[-1].lower() if "." in file.filename else ""
-        
-        print(f"🎧 Received: {file.filename} | Type: {content_type} | Size: {len(raw)} bytes | User: {current_user}")
-
-        # Try to load audio based on format
-        audio = None
-        formats_to_try = []
-        
-        # Determine which formats to attempt
-        if "webm" in content_type or file_ext == "webm":
-            formats_to_try = ["webm", "ogg"]
-        elif "mp4" in content_type or file_ext in ["mp4", "m4a"]:
-            formats_to_try = ["mp4", "m4a"]
-        elif "mpeg" in content_type or file_ext == "mp3":
-            formats_to_try = ["mp3"]
-        else:
-            # Try common formats as fallback
-            formats_to_try = ["webm", "mp4", "mp3", "ogg"]
-
-        # Attempt to decode audio
-        last_error = None
-        for fmt in formats_to_try:
-            try:
-                audio = AudioSegment.from_file(io.BytesIO(raw), format=fmt)
-                print(f"✅ Successfully decoded as {fmt}")
-                break
-            except Exception as e:
-                last_error = e
-                print(f"⚠️ Failed to decode as {fmt}: {e}")
-                continue
-
-        if audio is None:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Could not decode audio. Tried formats: {formats_to_try}. Last error: {str(last_error)}"
-            )
+        logger.info("Received: %s | Type: %s | Size: %d bytes | User: %s",
+                    file.filename, file.content_type, upload_size, current_user)
+
+        duration_ms = len(pcm) // PCM_BYTES_PER_MS
 
         # Check if audio has content
-        if len(audio) < 100:  # Less than 100ms
+        if duration_ms < 100:  # Less than 100ms
             raise HTTPException(status_code=400, detail="Audio too short (less than 100ms)")
 
-        # Convert to WAV for speech recognition (16kHz, mono)
-        wav_buf = io.BytesIO()
-        audio = audio.set_frame_rate(16000).set_channels(1)
-        audio.export(wav_buf, format="wav")
-        wav_buf.seek(0)
-        
-        print(f"🔊 Audio duration: {len(audio)}ms, Frame rate: {audio.frame_rate}Hz")
-
-        # Transcribe using Google Speech Recognition
-        recognizer = sr.Recognizer()
-        
-        # Adjust for ambient noise and energy threshold
-        with sr.AudioFile(wav_buf) as source:
-            # Adjust for background noise
-            recognizer.adjust_for_ambient_noise(source, duration=0.5)
-            audio_data = recognizer.record(source)
+        logger.info("Audio duration: %dms, Frame rate: %dHz", duration_ms, AUDIO_SAMPLE_RATE)
 
-        try:
-            print("🎤 Attempting transcription...")
-            text = recognizer.recognize_google(audio_data, language="en-US")
-            print(f"✅ Transcribed: {text}")
-            return {"text": text}
-            
-        except sr.UnknownValueError:
-            print("⚠️ Could not understand audio")
-            return {"text": "", "error": "Could not understand audio. Please speak clearly and try again."}
-            
-        except sr.RequestError as e:
-            print(f"❌ API Error: {e}")
-            raise HTTPException(
-                status_code=503, 
-                detail=f"Speech recognition service error: {str(e)}"
-            )
+        # Recording + Google STT are blocking; keep them off the event loop
+        return await asyncio.to_thread(do_transcribe, pcm, duration_ms)
 
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Unexpected error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Unexpected transcription error: %s", e)
         raise HTTPException(status_code=500, detail=f"Transcription failed: {str(e)}")
 
 @app.post("/api/chat/")
@@ -208,7 +359,7 @@ async def chat_with_rag(query: str = Form(...),
     """
     RAG chat - searches both worker notes and machine manuals.
     """
-    print(f"User '{current_user}' asked: {query} (machine_id={machine_id})")
+    logger.info("User '%s' asked: %s (machine_id=%s)", current_user, query, machine_id)
     result = generate_answer(query, machine_id=machine_id)
     return result
 
@@ -222,21 +373,25 @@ async def save_note(text: str = Form(...),
         if not text:
             raise HTTPException(status_code=400, detail="Note text cannot be empty")
 
-        print(f"Saving note for user '{current_user}' (machine_id={machine_id})")
+        logger.info("Saving note for user '%s' (machine_id=%s)", current_user, machine_id)
 
-        from rag.vector_store import generate_embedding, load_bm25_index
-        embedding = generate_embedding(text)
-
-        from rag.db import save_note as db_save_note
-        db_note_id = db_save_note(text, embedding, machine_id=machine_id)
+        # Embedding (CPU-bound) and the row INSERT don't depend on each other; run them together
+        embedding_task = asyncio.create_task(asyncio.to_thread(generate_embedding, text))
+        insert_task = asyncio.create_task(asyncio.to_thread(insert_note_text, text, machine_id))
+        db_note_id = await insert_task
+        try:
+            embedding = await embedding_task
+        except Exception:
+            await asyncio.to_thread(delete_note, db_note_id)
+            raise
+        await asyncio.to_thread(set_note_embedding, db_note_id, embedding)
 
-        load_bm25_index(machine_id)
+        # Append to the live BM25 corpus instead of reloading it from the DB
+        await asyncio.to_thread(add_note_to_bm25, db_note_id, text, machine_id)
 
-        print(f"Note saved with DB ID: {db_note_id}")
+        logger.info("Note saved with DB ID: %s", db_note_id)
         return {"note_id": db_note_id, "message": "Note saved successfully"}
 
     except Exception as e:
-        print(f"Error saving note: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error saving note: %s", e)
         raise HTTPException(status_code=500, detail=f"Error saving note: {str(e)}")
@@ -0,0 +1,54 @@
+"""
+Numba BM25 scoring kernel over the doc-major CSR arrays built by
+rag.vector_store._build_bm25_arrays.
+
+Importing this module compiles the kernel on a tiny dummy corpus, so the first real
+query doesn't pay the JIT cost. With numba missing, NUMBA_AVAILABLE is False and
+bm25_score_njit is None.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:  # rag.vector_store falls back to its NumPy scorer
+    njit = None
+
+NUMBA_AVAILABLE = njit is not None
+
+bm25_score_njit = None
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def bm25_score_njit(query_term_ids, idf, tf, indptr, indices, doc_len, avgdl, k1, b, out):
+        """
+        Write the BM25 score of every document into out (float32, length n_docs).
+        No bounds checks: out must have at least doc_len.shape[0] entries.
+        """
+        for d in prange(doc_len.shape[0]):
+            start = indptr[d]
+            stop = indptr[d + 1]
+            row = indices[start:stop]
+            norm = k1 * (1.0 - b + b * doc_len[d] / avgdl)
+            score = 0.0
+            for j in range(query_term_ids.shape[0]):
+                term_id = query_term_ids[j]
+                pos = np.searchsorted(row, term_id)
+                if pos < row.shape[0] and row[pos] == term_id:
+                    freq = tf[start + pos]
+                    score += idf[term_id] * (freq * (k1 + 1.0)) / (freq + norm)
+            out[d] = score
+
+    def _warmup():
+        # Same dtypes as _build_bm25_arrays, so this compiles the signature queries use:
+        # two docs, [0, 1] and [1]
+        out = np.empty(2, dtype=np.float32)
+        index = (np.array([0.5, 0.1]), np.array([1.0, 1.0, 1.0]), np.array([0, 2, 3], dtype=np.int64),
+                 np.array([0, 1, 1], dtype=np.int32), np.array([2.0, 1.0]))
+        bm25_score_njit(np.array([1], dtype=np.int32), *index, 1.5, 1.5, 0.75, out)
+        # Indexes loaded from a snapshot are read-only memory maps, a separate numba signature
+        for array in index:
+            array.flags.writeable = False
+        bm25_score_njit(np.array([1], dtype=np.int32), *index, 1.5, 1.5, 0.75, out)
+
+    _warmup()
@@ -0,0 +1,46 @@
+"""
+BM25 tokenization into integer term ids.
+
+Kept free of heavy imports (DB driver, embedder, numba) because encode_shard runs in
+spawned worker processes during large index rebuilds; see rag.vector_store._encode_corpus.
+"""
+
+import re
+import string
+import numpy as np
+
+_TOKEN_RE = re.compile(r"\w+")
+
+# ASCII \w characters map to themselves (uppercase lowercased), every other byte to a space
+_WORD_BYTES = frozenset((string.ascii_letters + string.digits + "_").encode())
+_TOKEN_TABLE = bytes(
+    (ord(chr(c).lower()) if c in _WORD_BYTES else 0x20) for c in range(256)
+)
+
+
+def tokenize(text: str):
+    # Lowercase and split on non-word characters in one bytes.translate pass; identical to the
+    # regex for ASCII text, which keeps it for anything else (Unicode \w, case folding)
+    if text.isascii():
+        return text.encode("ascii").translate(_TOKEN_TABLE).decode("ascii").split()
+    return _TOKEN_RE.findall(text.lower())
+
+
+def encode_tokens(tokens: list, vocab: dict) -> np.ndarray:
+    """Term ids of tokens, adding unseen terms to vocab (term -> id)."""
+    return np.fromiter((vocab.setdefault(token, len(vocab)) for token in tokens),
+                       dtype=np.int32, count=len(tokens))
+
+
+def encode_shard(texts: list):
+    """
+    Tokenize texts against a shard-local vocabulary.
+    Returns (terms, term_ids, doc_lens): terms[i] is the term with local id i, term_ids the
+    ids of every token of every text in order, doc_lens the token count of each text.
+    """
+    vocab = {}
+    tokenized = [tokenize(text) for text in texts]
+    doc_lens = np.fromiter(map(len, tokenized), dtype=np.int64, count=len(tokenized))
+    term_ids = np.fromiter((vocab.setdefault(token, len(vocab)) for tokens in tokenized for token in tokens),
+                           dtype=np.int32, count=int(doc_lens.sum()))
+    return list(vocab), term_ids, doc_lens
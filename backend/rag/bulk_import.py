@@ -1,29 +1,58 @@
-import pandas as pd
-from rag.db import save_note_to_db
-from rag.vector_store import add_note_to_chroma
+import openpyxl
+from rag.db import save_notes_bulk
+from rag.vector_store import generate_embeddings_batch, load_bm25_index
 
 # Path to your exported Excel file
 EXCEL_PATH = "data/notes.xlsx"
 
-def import_notes():
-    df = pd.read_excel(EXCEL_PATH)
-
-    for _, row in df.iterrows():
-        note_id = int(row["note_id"])
-        text = str(row["text"]).strip()
-
-        if not text:
-            continue
-
-        print(f"📝 Importing note {note_id}...")
+# Notes are embedded and inserted this many at a time
+BATCH_SIZE = 256
+
+def iter_note_texts(path: str = EXCEL_PATH):
+    """Stream non-empty note texts from the sheet without loading the whole workbook."""
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        text_col = list(header).index("text")
+        for row in rows:
+            if text_col >= len(row) or row[text_col] is None:
+                continue
+            text = str(row[text_col]).strip()
+            if text:
+                yield text
+    finally:
+        wb.close()
+
+def _flush(texts: list):
+    print(f"📝 Importing {len(texts)} notes...")
+    embeddings = generate_embeddings_batch(texts)
+    # Save to PostgreSQL in one round-trip per batch
+    save_notes_bulk(texts, embeddings)
 
-        # Save to MySQL
-        db_id = save_note_to_db(text)
-
-        # Save to Chroma
-        add_note_to_chroma(db_id, text)
-
-    print("All notes imported successfully!")
+def import_notes():
+    total = 0
+    batch = []
+    for text in iter_note_texts():
+        batch.append(text)
+        if len(batch) >= BATCH_SIZE:
+            _flush(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        _flush(batch)
+        total += len(batch)
+
+    if not total:
+        print("No notes to import.")
+        return
+
+    # Refresh keyword index
+    load_bm25_index()
+
+    print(f"All {total} notes imported successfully!")
 
 if __name__ == "__main__":
-    import_notes()
\ No newline at end of file
+    import logging
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    import_notes()
@@ -1,11 +1,14 @@
 from datetime import datetime
+import logging
 import os
+import threading
 import numpy as np
 import psycopg2
 from psycopg2 import pool
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from pgvector.psycopg2 import register_vector
 from contextlib import contextmanager
+from cachetools import TTLCache, cached
 
 
 DB_CONFIG = {
@@ -21,59 +24,129 @@ else:
     DB_CONFIG['host'] = os.getenv('POSTGRES_HOST', 'localhost')
     DB_CONFIG['port'] = int(os.getenv('POSTGRES_PORT', 5433))
 
+logger = logging.getLogger(__name__)
+
 _connection_pool = None
 
+
+# Sized for the FastAPI threadpool: every worker thread can hold a connection without waiting
+PG_POOL_MIN = 4
+PG_POOL_MAX = int(os.getenv('PG_POOL_MAX', 32))
+
+_pool_lock = threading.Lock()
+
+
+def _register_vector_adapter(conn) -> bool:
+    """Register pgvector adapters on conn. Returns False if the extension doesn't exist yet."""
+    try:
+        register_vector(conn)
+    except psycopg2.ProgrammingError:
+        # Fresh database: init_db hasn't created the extension yet
+        conn.rollback()
+        return False
+    conn.commit()  # close the type-lookup transaction before the connection is pooled
+    return True
+
+
+class VectorConnectionPool(pool.ThreadedConnectionPool):
+    """Thread-safe pool that registers pgvector adapters once per physical connection."""
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        # Connections opened before CREATE EXTENSION; retried on checkout (set before super() connects)
+        self._unregistered = set()
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        if not _register_vector_adapter(conn):
+            self._unregistered.add(conn)
+        return conn
+
+    def getconn(self, key=None):
+        conn = super().getconn(key)
+        if conn in self._unregistered and _register_vector_adapter(conn):
+            self._unregistered.discard(conn)
+        return conn
+
+
 def get_connection_pool():
     """Get or create a connection pool."""
     global _connection_pool
     if _connection_pool is None:
-        try:
-            _connection_pool = psycopg2.pool.SimpleConnectionPool(
-                minconn=1,
-                maxconn=10,
-                **DB_CONFIG
-            )
-            print("PostgreSQL connection pool created")
-        except Exception as e:
-            print(f"Error creating connection pool: {e}")
-            raise
+        with _pool_lock:
+            if _connection_pool is None:
+                try:
+                    _connection_pool = VectorConnectionPool(
+                        minconn=PG_POOL_MIN,
+                        maxconn=PG_POOL_MAX,
+                        **DB_CONFIG
+                    )
+                    logger.info("PostgreSQL connection pool created (max %d connections)", PG_POOL_MAX)
+                except Exception as e:
+                    logger.error("Error creating connection pool: %s", e)
+                    raise
     return _connection_pool
 
-_vector_registered = False
+
+def close_pool():
+    """Close every pooled connection (call on application shutdown)."""
+    global _connection_pool
+    with _pool_lock:
+        if _connection_pool is not None:
+            _connection_pool.closeall()
+            _connection_pool = None
+            logger.info("PostgreSQL connection pool closed")
 
 @contextmanager
 def get_db_connection():
     """Context manager to get a database connection from the pool."""
-    global _vector_registered
     pool = get_connection_pool()
     connection = None
     try:
         connection = pool.getconn()
-        if _vector_registered:
-            register_vector(connection)
         yield connection
         connection.commit()
     except Exception as e:
         if connection:
             connection.rollback()
-        print(f"Database error: {e}")
+        logger.error("Database error: %s", e)
         raise
     finally:
         if connection:
             pool.putconn(connection)
 
+HNSW_EF_SEARCH = 40
+
+
+def configure_hnsw_params(vector_count: int):
+    """Pick HNSW build parameters (m, ef_construction) for the expected table size."""
+    if vector_count > 100_000:
+        return 24, 100
+    return 16, 64
+
+
+def normalize_embedding(embedding) -> np.ndarray:
+    """Unit-length float32 copy of embedding (inner-product search equals cosine only on unit vectors)."""
+    e = np.array(embedding, dtype=np.float32)
+    e /= np.linalg.norm(e) + 1e-12
+    return e
+
+
+def ef_search_sql(top_k: int, ef_search: int = HNSW_EF_SEARCH) -> str:
+    """
+    SET LOCAL hnsw.ef_search statement (at least the LIMIT, so the scan can fill it).
+    Prepended to the search query so both go to the server in one round trip.
+    """
+    return f"SET LOCAL hnsw.ef_search = {int(max(ef_search, top_k * 2))};\n"
+
 
 def init_db():
     """Create all tables if they don't exist. Must be called before other DB operations."""
-    global _vector_registered
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
         conn.commit()
 
-    # Now that vector extension exists, enable registration for future connections
-    _vector_registered = True
-
     with get_db_connection() as conn:
         cursor = conn.cursor()
 
@@ -107,7 +180,7 @@ def init_db():
             CREATE TABLE IF NOT EXISTS notes (
                 id SERIAL PRIMARY KEY,
                 text TEXT NOT NULL,
-                embedding vector(384),
+                embedding halfvec(384),
                 machine_id INT REFERENCES machines(id),
                 created_at TIMESTAMP DEFAULT NOW()
             );
@@ -121,7 +194,7 @@ def init_db():
                 page_number INT,
                 section_title VARCHAR(255),
                 chunk_type VARCHAR(50) DEFAULT 'text',
-                embedding vector(384),
+                embedding halfvec(384),
                 created_at TIMESTAMP DEFAULT NOW()
             );
         """)
@@ -139,13 +212,64 @@ def init_db():
             END $$;
         """)
 
+        # ANN indexes so similarity search doesn't sequential-scan every embedding.
+        # Embeddings are stored as FP16 halfvec (pgvector >= 0.7): half the bytes per
+        # neighbour fetch of FP32 vector. Older DBs are migrated in place; the old
+        # vector_cosine_ops index can't survive the type change, so it is dropped first.
+        # Embeddings are unit-length, so the index uses inner product (<#>): cosine
+        # similarity without the per-comparison norms. Rows are re-normalized once, before
+        # the ip index is first built, in case they predate normalization at write time.
+        for table, old_index, index_name in (
+                ("notes", "idx_notes_embedding_hnsw", "idx_notes_embedding_hnsw_ip"),
+                ("manual_chunks", "idx_manual_chunks_embedding_hnsw", "idx_manual_chunks_embedding_hnsw_ip")):
+            cursor.execute(f"""
+                DO $$
+                BEGIN
+                    IF EXISTS (
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_name = '{table}' AND column_name = 'embedding'
+                          AND udt_name = 'vector'
+                    ) THEN
+                        DROP INDEX IF EXISTS {old_index};
+                        ALTER TABLE {table} ALTER COLUMN embedding TYPE halfvec(384)
+                            USING embedding::halfvec(384);
+                    END IF;
+                    IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = '{index_name}') THEN
+                        DROP INDEX IF EXISTS {old_index};
+                        UPDATE {table} SET embedding = l2_normalize(embedding)
+                            WHERE embedding IS NOT NULL;
+                    END IF;
+                END $$;
+            """)
+            cursor.execute(f"SELECT count(*) FROM {table};")
+            m, ef_construction = configure_hnsw_params(cursor.fetchone()[0])
+            cursor.execute(f"""
+                CREATE INDEX IF NOT EXISTS {index_name} ON {table}
+                USING hnsw (embedding halfvec_ip_ops)
+                WITH (m = {m}, ef_construction = {ef_construction});
+            """)
+
+        # Full-text search: generated tsvector columns + GIN indexes (keyword backend "postgres")
+        cursor.execute("""
+            ALTER TABLE notes ADD COLUMN IF NOT EXISTS text_tsv tsvector
+                GENERATED ALWAYS AS (to_tsvector('english', text)) STORED;
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notes_text_tsv ON notes USING GIN (text_tsv);")
+        cursor.execute("""
+            ALTER TABLE manual_chunks ADD COLUMN IF NOT EXISTS chunk_tsv tsvector
+                GENERATED ALWAYS AS (to_tsvector('english', chunk_text)) STORED;
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_manual_chunks_chunk_tsv ON manual_chunks USING GIN (chunk_tsv);")
+
         conn.commit()
         cursor.close()
-        print("Database tables initialized")
+        logger.info("Database tables initialized")
 
 
 # --- Machine operations ---
 
+# Machines change rarely; the dropdown list is served from memory for up to a minute
+@cached(TTLCache(maxsize=1, ttl=60), lock=threading.Lock())
 def get_machines():
     """Retrieve all machines for dropdown."""
     with get_db_connection() as conn:
@@ -169,6 +293,7 @@ def create_machine(name: str, description: str = None):
         machine_id = cursor.fetchone()[0]
         conn.commit()
         cursor.close()
+        get_machines.cache_clear()
         return machine_id
 
 
@@ -208,7 +333,7 @@ def save_manual_chunk(manual_id: int, chunk_text: str, embedding: list,
     """Save a manual chunk with its embedding."""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        embedding_array = np.array(embedding)
+        embedding_array = normalize_embedding(embedding)
         cursor.execute(
             """INSERT INTO manual_chunks
                (manual_id, chunk_text, page_number, section_title, chunk_type, embedding)
@@ -221,6 +346,33 @@ def save_manual_chunk(manual_id: int, chunk_text: str, embedding: list,
         return chunk_id
 
 
+def save_manual_chunks_bulk(manual_id: int, chunks: list) -> int:
+    """
+    Save many chunks for one manual in a single INSERT under one commit.
+    chunks: list of (chunk_text, embedding, page_number, section_title, chunk_type).
+    Returns the number of rows inserted.
+    """
+    if not chunks:
+        return 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        rows = [
+            (manual_id, text, page_number, section_title, chunk_type, normalize_embedding(embedding))
+            for text, embedding, page_number, section_title, chunk_type in chunks
+        ]
+        execute_values(
+            cursor,
+            """INSERT INTO manual_chunks
+               (manual_id, chunk_text, page_number, section_title, chunk_type, embedding)
+               VALUES %s;""",
+            rows,
+            page_size=200,
+        )
+        conn.commit()
+        cursor.close()
+        return len(rows)
+
+
 def delete_chunks_by_manual(manual_id: int):
     """Delete all chunks for a manual (for re-ingestion)."""
     with get_db_connection() as conn:
@@ -236,7 +388,7 @@ def save_note(text: str, embedding: list, machine_id: int = None) -> int:
     """Save a note and its embedding to the database."""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        embedding_array = np.array(embedding)
+        embedding_array = normalize_embedding(embedding)
         cursor.execute(
             """INSERT INTO notes (text, embedding, machine_id)
                VALUES (%s, %s, %s) RETURNING id;""",
@@ -245,10 +397,65 @@ def save_note(text: str, embedding: list, machine_id: int = None) -> int:
         note_id = cursor.fetchone()[0]
         conn.commit()
         cursor.close()
-        print(f"Note saved with ID: {note_id}")
+        logger.info("Note saved with ID: %s", note_id)
+        return note_id
+
+
+def insert_note_text(text: str, machine_id: int = None) -> int:
+    """Insert a note without its embedding (filled in by set_note_embedding). Returns the id."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO notes (text, machine_id) VALUES (%s, %s) RETURNING id;",
+            (text, machine_id)
+        )
+        note_id = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
         return note_id
 
 
+def set_note_embedding(note_id: int, embedding: list):
+    """Attach an embedding to an existing note."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE notes SET embedding = %s WHERE id = %s;",
+            (normalize_embedding(embedding), note_id)
+        )
+        conn.commit()
+        cursor.close()
+
+
+def delete_note(note_id: int):
+    """Delete a single note."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM notes WHERE id = %s;", (note_id,))
+        conn.commit()
+        cursor.close()
+
+
+def save_notes_bulk(texts: list, embeddings, machine_id: int = None) -> list:
+    """Save many notes in a single INSERT. Returns the new ids in input order."""
+    if not texts:
+        return []
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        rows = [(text, normalize_embedding(embedding), machine_id) for text, embedding in zip(texts, embeddings)]
+        note_ids = execute_values(
+            cursor,
+            "INSERT INTO notes (text, embedding, machine_id) VALUES %s RETURNING id;",
+            rows,
+            page_size=200,
+            fetch=True,
+        )
+        conn.commit()
+        cursor.close()
+        logger.info("%d notes saved", len(note_ids))
+        return [row[0] for row in note_ids]
+
+
 def get_all_notes():
     """Retrieve all notes from the database."""
     with get_db_connection() as conn:
@@ -259,117 +466,362 @@ def get_all_notes():
         return notes
 
 
-def search_similar_notes(query_embedding: list, top_k: int = 5, machine_id: int = None):
+def search_similar_notes(query_embedding: list, top_k: int = 5, machine_id: int = None,
+                         ef_search: int = HNSW_EF_SEARCH):
     """Find similar notes. If machine_id given, filter to that machine + unassigned notes."""
     with get_db_connection() as conn:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
-        embedding_array = np.array(query_embedding)
+        set_ef_search = ef_search_sql(top_k, ef_search)
+        embedding_array = normalize_embedding(query_embedding)
 
         if machine_id is not None:
             query = """
             SELECT id, text, created_at,
-                   (1 - (embedding <=> %s)) AS similarity
+                   (-(embedding <#> %s::halfvec)) AS similarity
             FROM notes
             WHERE embedding IS NOT NULL
               AND (machine_id = %s OR machine_id IS NULL)
-            ORDER BY embedding <=> %s
+            ORDER BY embedding <#> %s::halfvec
             LIMIT %s;
             """
-            cursor.execute(query, (embedding_array, machine_id, embedding_array, top_k))
+            cursor.execute(set_ef_search + query, (embedding_array, machine_id, embedding_array, top_k))
         else:
             query = """
             SELECT id, text, created_at,
-                   (1 - (embedding <=> %s)) AS similarity
+                   (-(embedding <#> %s::halfvec)) AS similarity
             FROM notes
             WHERE embedding IS NOT NULL
-            ORDER BY embedding <=> %s
+            ORDER BY embedding <#> %s::halfvec
             LIMIT %s;
             """
-            cursor.execute(query, (embedding_array, embedding_array, top_k))
+            cursor.execute(set_ef_search + query, (embedding_array, embedding_array, top_k))
 
         results = cursor.fetchall()
         cursor.close()
         return results
 
 
-def search_similar_chunks(query_embedding: list, top_k: int = 5, machine_id: int = None):
+def search_similar_chunks(query_embedding: list, top_k: int = 5, machine_id: int = None,
+                          ef_search: int = HNSW_EF_SEARCH):
     """Find similar manual chunks. If machine_id given, filter to that machine's manuals."""
     with get_db_connection() as conn:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
-        embedding_array = np.array(query_embedding)
+        set_ef_search = ef_search_sql(top_k, ef_search)
+        embedding_array = normalize_embedding(query_embedding)
 
         if machine_id is not None:
             query = """
             SELECT mc.id, mc.chunk_text, mc.page_number, mc.section_title,
                    mc.chunk_type, m.title AS manual_title, m.manual_type,
-                   (1 - (mc.embedding <=> %s)) AS similarity
+                   (-(mc.embedding <#> %s::halfvec)) AS similarity
             FROM manual_chunks mc
             JOIN manuals m ON mc.manual_id = m.id
             JOIN machine_manuals mm ON m.id = mm.manual_id
             WHERE mc.embedding IS NOT NULL
               AND mm.machine_id = %s
-            ORDER BY mc.embedding <=> %s
+            ORDER BY mc.embedding <#> %s::halfvec
             LIMIT %s;
             """
-            cursor.execute(query, (embedding_array, machine_id, embedding_array, top_k))
+            cursor.execute(set_ef_search + query, (embedding_array, machine_id, embedding_array, top_k))
         else:
             query = """
             SELECT mc.id, mc.chunk_text, mc.page_number, mc.section_title,
                    mc.chunk_type, m.title AS manual_title, m.manual_type,
-                   (1 - (mc.embedding <=> %s)) AS similarity
+                   (-(mc.embedding <#> %s::halfvec)) AS similarity
             FROM manual_chunks mc
             JOIN manuals m ON mc.manual_id = m.id
             WHERE mc.embedding IS NOT NULL
-            ORDER BY mc.embedding <=> %s
+            ORDER BY mc.embedding <#> %s::halfvec
             LIMIT %s;
             """
-            cursor.execute(query, (embedding_array, embedding_array, top_k))
+            cursor.execute(set_ef_search + query, (embedding_array, embedding_array, top_k))
 
         results = cursor.fetchall()
         cursor.close()
         return results
 
 
-def get_all_notes_for_bm25(machine_id: int = None):
-    """Retrieve notes for BM25 indexing, optionally filtered by machine."""
+_SEARCH_UNION_SQL = """
+(SELECT 'note' AS source_type, n.id, n.text, n.created_at,
+        NULL::int AS page_number, NULL::text AS section_title, NULL::text AS chunk_type,
+        NULL::text AS manual_title, NULL::text AS manual_type,
+        (-(n.embedding <#> %(embedding)s::halfvec)) AS similarity
+ FROM notes n
+ WHERE n.embedding IS NOT NULL {note_filter}
+ ORDER BY n.embedding <#> %(embedding)s::halfvec
+ LIMIT %(top_k)s)
+UNION ALL
+(SELECT 'manual', mc.id, mc.chunk_text, NULL,
+        mc.page_number, mc.section_title, mc.chunk_type,
+        m.title, m.manual_type,
+        (-(mc.embedding <#> %(embedding)s::halfvec))
+ FROM manual_chunks mc
+ JOIN manuals m ON mc.manual_id = m.id
+ WHERE mc.embedding IS NOT NULL {chunk_filter}
+ ORDER BY mc.embedding <#> %(embedding)s::halfvec
+ LIMIT %(top_k)s)
+ORDER BY source_type DESC, similarity DESC;
+"""
+
+
+def search_similar_union(query_embedding: list, top_k: int = 5, machine_id: int = None,
+                         ef_search: int = HNSW_EF_SEARCH):
+    """
+    search_similar_notes and search_similar_chunks in one round trip: up to top_k of each,
+    notes first, each source best-first. Rows carry source_type and are shaped like the
+    matching function's rows (manual rows get chunk_text, not text).
+    """
+    if machine_id is not None:
+        note_filter = "AND (n.machine_id = %(machine_id)s OR n.machine_id IS NULL)"
+        chunk_filter = ("AND mc.manual_id IN "
+                        "(SELECT manual_id FROM machine_manuals WHERE machine_id = %(machine_id)s)")
+    else:
+        note_filter = chunk_filter = ""
+
+    query = _SEARCH_UNION_SQL.format(note_filter=note_filter, chunk_filter=chunk_filter)
+    params = {'embedding': normalize_embedding(query_embedding), 'top_k': top_k, 'machine_id': machine_id}
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(ef_search_sql(top_k, ef_search) + query, params)
+        rows = cursor.fetchall()
+        cursor.close()
+
+    # UNION ALL takes its column names from the notes branch
+    for row in rows:
+        if row['source_type'] == 'manual':
+            row['chunk_text'] = row.pop('text')
+    return rows
+
+
+def search_similar_chunks_batch(query_embeddings, top_k: int = 5, machine_id: int = None,
+                                ef_search: int = HNSW_EF_SEARCH):
+    """
+    Run search_similar_chunks for many query vectors in one round trip.
+    query_embeddings is an (N, 384) array or a list of vectors. Returns a list of N result
+    lists, in query order, each shaped like search_similar_chunks' rows.
+    """
+    vectors = [normalize_embedding(v) for v in query_embeddings]
+    if not vectors:
+        return []
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        set_ef_search = ef_search_sql(top_k, ef_search)
+
+        if machine_id is not None:
+            query = """
+            SELECT q.q_idx, t.*
+            FROM unnest(%s::halfvec[]) WITH ORDINALITY AS q(v, q_idx)
+            JOIN LATERAL (
+                SELECT mc.id, mc.chunk_text, mc.page_number, mc.section_title,
+                       mc.chunk_type, m.title AS manual_title, m.manual_type,
+                       (-(mc.embedding <#> q.v)) AS similarity
+                FROM manual_chunks mc
+                JOIN manuals m ON mc.manual_id = m.id
+                JOIN machine_manuals mm ON m.id = mm.manual_id
+                WHERE mc.embedding IS NOT NULL
+                  AND mm.machine_id = %s
+                ORDER BY mc.embedding <#> q.v
+                LIMIT %s
+            ) t ON true
+            ORDER BY q.q_idx, t.similarity DESC;
+            """
+            cursor.execute(set_ef_search + query, (vectors, machine_id, top_k))
+        else:
+            query = """
+            SELECT q.q_idx, t.*
+            FROM unnest(%s::halfvec[]) WITH ORDINALITY AS q(v, q_idx)
+            JOIN LATERAL (
+                SELECT mc.id, mc.chunk_text, mc.page_number, mc.section_title,
+                       mc.chunk_type, m.title AS manual_title, m.manual_type,
+                       (-(mc.embedding <#> q.v)) AS similarity
+                FROM manual_chunks mc
+                JOIN manuals m ON mc.manual_id = m.id
+                WHERE mc.embedding IS NOT NULL
+                ORDER BY mc.embedding <#> q.v
+                LIMIT %s
+            ) t ON true
+            ORDER BY q.q_idx, t.similarity DESC;
+            """
+            cursor.execute(set_ef_search + query, (vectors, top_k))
+
+        rows = cursor.fetchall()
+        cursor.close()
+
+    results = [[] for _ in vectors]
+    for row in rows:
+        results[row.pop('q_idx') - 1].append(row)
+    return results
+
+
+HYBRID_EF_SEARCH = 100
+
+_HYBRID_SEARCH_SQL = """
+WITH q AS (
+    SELECT plainto_tsquery('english', %(query_text)s) AS tsq
+),
+note_ids AS (
+    (SELECT n.id FROM notes n
+     WHERE n.embedding IS NOT NULL {note_filter}
+     ORDER BY n.embedding <#> %(embedding)s::halfvec
+     LIMIT %(sem_k)s)
+    UNION
+    (SELECT n.id FROM notes n, q
+     WHERE n.text_tsv @@ q.tsq {note_filter}
+     ORDER BY ts_rank_cd(n.text_tsv, q.tsq) DESC
+     LIMIT %(kw_k)s)
+),
+chunk_ids AS (
+    (SELECT mc.id FROM manual_chunks mc
+     WHERE mc.embedding IS NOT NULL {chunk_filter}
+     ORDER BY mc.embedding <#> %(embedding)s::halfvec
+     LIMIT %(sem_k)s)
+    UNION
+    (SELECT mc.id FROM manual_chunks mc, q
+     WHERE mc.chunk_tsv @@ q.tsq {chunk_filter}
+     ORDER BY ts_rank_cd(mc.chunk_tsv, q.tsq) DESC
+     LIMIT %(kw_k)s)
+),
+candidates AS (
+    SELECT 'note' AS source_type, n.id, n.text, n.created_at,
+           NULL::int AS page_number, NULL::text AS section_title,
+           NULL::text AS chunk_type, NULL::text AS manual_title,
+           COALESCE(-(n.embedding <#> %(embedding)s::halfvec), 0) AS sem,
+           ts_rank_cd(n.text_tsv, q.tsq) AS kw
+    FROM notes n JOIN note_ids USING (id), q
+    UNION ALL
+    SELECT 'manual', mc.id, mc.chunk_text, NULL,
+           mc.page_number, mc.section_title,
+           mc.chunk_type, m.title,
+           COALESCE(-(mc.embedding <#> %(embedding)s::halfvec), 0),
+           ts_rank_cd(mc.chunk_tsv, q.tsq)
+    FROM manual_chunks mc JOIN chunk_ids USING (id)
+    JOIN manuals m ON mc.manual_id = m.id, q
+),
+scored AS (
+    SELECT *, COALESCE(kw / NULLIF(MAX(kw) OVER (), 0), 0) AS kw_norm
+    FROM candidates
+)
+SELECT *, %(alpha)s * sem + (1 - %(alpha)s) * kw_norm AS score
+FROM scored
+ORDER BY score DESC
+LIMIT %(top_k)s;
+"""
+
+
+def hybrid_search(query_embedding: list, query_text: str, top_k: int = 5, alpha: float = 0.6,
+                  machine_id: int = None, ef_search: int = HYBRID_EF_SEARCH):
+    """
+    Hybrid search over notes and manual chunks in one query.
+
+    Candidates are the nearest neighbours (HNSW) plus the full-text matches (GIN) from each
+    table; score = alpha * cosine similarity + (1 - alpha) * ts_rank_cd normalized to the best
+    candidate. If machine_id given, filter like search_similar_notes / search_similar_chunks.
+    """
+    if machine_id is not None:
+        note_filter = "AND (n.machine_id = %(machine_id)s OR n.machine_id IS NULL)"
+        chunk_filter = ("AND mc.manual_id IN "
+                        "(SELECT manual_id FROM machine_manuals WHERE machine_id = %(machine_id)s)")
+    else:
+        note_filter = chunk_filter = ""
+
+    query = _HYBRID_SEARCH_SQL.format(note_filter=note_filter, chunk_filter=chunk_filter)
+    params = {
+        'query_text': query_text,
+        'embedding': normalize_embedding(query_embedding),
+        'sem_k': top_k * 2,
+        'kw_k': top_k * 4,
+        'alpha': alpha,
+        'top_k': top_k,
+        'machine_id': machine_id,
+    }
+
     with get_db_connection() as conn:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(ef_search_sql(top_k * 2, ef_search) + query, params)
+        results = cursor.fetchall()
+        cursor.close()
+        return results
+
+
+def get_index_version():
+    """
+    (max note id, max manual chunk id). Ids are sequential, so this moves whenever notes are added
+    or manuals are (re-)ingested; cached BM25 indexes compare against it to know they're stale.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT (SELECT max(id) FROM notes), (SELECT max(id) FROM manual_chunks);")
+        version = tuple(cursor.fetchone())
+        cursor.close()
+        return version
+
+
+def get_all_notes_for_bm25(machine_id: int = None):
+    """Retrieve (id, text) of notes for BM25 indexing, optionally filtered by machine."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
         if machine_id is not None:
             cursor.execute(
-                "SELECT id, text, created_at FROM notes WHERE machine_id = %s OR machine_id IS NULL ORDER BY id;",
+                "SELECT id, text FROM notes WHERE machine_id = %s OR machine_id IS NULL ORDER BY id;",
                 (machine_id,)
             )
         else:
-            cursor.execute("SELECT id, text, created_at FROM notes ORDER BY id;")
+            cursor.execute("SELECT id, text FROM notes ORDER BY id;")
         notes = cursor.fetchall()
         cursor.close()
         return notes
 
 
 def get_all_chunks_for_bm25(machine_id: int = None):
-    """Retrieve manual chunks for BM25 indexing, optionally filtered by machine."""
+    """
+    Retrieve (id, chunk_text) of manual chunks for BM25 indexing, optionally filtered by machine.
+    Display metadata is fetched only for hits that make the final ranking (get_chunks_by_ids).
+    """
     with get_db_connection() as conn:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor = conn.cursor()
         if machine_id is not None:
             query = """
-            SELECT mc.id, mc.chunk_text, mc.page_number, mc.section_title,
-                   mc.chunk_type, m.title AS manual_title, m.manual_type
+            SELECT mc.id, mc.chunk_text
             FROM manual_chunks mc
-            JOIN manuals m ON mc.manual_id = m.id
-            JOIN machine_manuals mm ON m.id = mm.manual_id
-            WHERE mm.machine_id = %s
+            WHERE mc.manual_id IN (SELECT manual_id FROM machine_manuals WHERE machine_id = %s)
             ORDER BY mc.id;
             """
             cursor.execute(query, (machine_id,))
         else:
-            query = """
-            SELECT mc.id, mc.chunk_text, mc.page_number, mc.section_title,
-                   mc.chunk_type, m.title AS manual_title, m.manual_type
-            FROM manual_chunks mc
-            JOIN manuals m ON mc.manual_id = m.id
-            ORDER BY mc.id;
-            """
-            cursor.execute(query)
+            cursor.execute("SELECT id, chunk_text FROM manual_chunks ORDER BY id;")
+        chunks = cursor.fetchall()
+        cursor.close()
+        return chunks
+
+
+def get_notes_by_ids(note_ids: list):
+    """Fetch notes by id, shaped like search_similar_notes rows (without similarity)."""
+    if not note_ids:
+        return []
+    with get_db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("SELECT id, text, created_at FROM notes WHERE id = ANY(%s);", (list(note_ids),))
+        notes = cursor.fetchall()
+        cursor.close()
+        return notes
+
+
+def get_chunks_by_ids(chunk_ids: list):
+    """Fetch manual chunks by id, shaped like search_similar_chunks rows (without similarity)."""
+    if not chunk_ids:
+        return []
+    with get_db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        query = """
+        SELECT mc.id, mc.chunk_text, mc.page_number, mc.section_title,
+               mc.chunk_type, m.title AS manual_title, m.manual_type
+        FROM manual_chunks mc
+        JOIN manuals m ON mc.manual_id = m.id
+        WHERE mc.id = ANY(%s);
+        """
+        cursor.execute(query, (list(chunk_ids),))
         chunks = cursor.fetchall()
         cursor.close()
-        return chunks
\ No newline at end of file
+        return chunks
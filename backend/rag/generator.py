@@ -1,3 +0,0 @@
-def answer_query(query: str) -> str:
-    # TODO: plug your RAG here (FAISS/Chroma/LangChain/etc.)
-    return f"(stub) You asked: {query}"
\ No newline at end of file
@@ -0,0 +1,77 @@
+"""
+ONNX Runtime embedder for all-MiniLM-L6-v2.
+
+Drop-in replacement for the subset of SentenceTransformer.encode this app uses:
+tokenize -> exported transformer -> mean pooling over the attention mask -> L2 normalize
+(the same Transformer/Pooling/Normalize stack as models/all-MiniLM-L6-v2/modules.json).
+
+Export the model once (dynamic-INT8 quantized by default) into models/all-MiniLM-L6-v2-onnx:
+
+    python -m scripts.export_onnx
+"""
+
+import os
+import numpy as np
+
+# Preferred file first: the INT8-quantized export when it exists
+ONNX_MODEL_FILES = ("model_quantized.onnx", "model.onnx")
+
+
+def find_onnx_model(model_dir):
+    """Return the path of the exported ONNX model in model_dir, or None."""
+    for name in ONNX_MODEL_FILES:
+        path = os.path.join(model_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class OnnxEmbedder:
+    """Sentence embedder backed by an onnxruntime InferenceSession."""
+
+    def __init__(self, model_dir, model_path: str = None, max_seq_length: int = 256):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_path = model_path or find_onnx_model(str(model_dir))
+        if model_path is None:
+            raise FileNotFoundError(f"No ONNX model found in {model_dir}")
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(str(model_dir), "tokenizer.json"))
+        # tokenizer.json ships with fixed 128-token padding; pad per batch and truncate like ST does
+        self.tokenizer.enable_truncation(max_length=max_seq_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = os.cpu_count() or 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.model_path = model_path
+
+    def _embed_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.asarray([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+
+        hidden = self.session.run(None, feeds)[0]  # (batch, seq, dim)
+        mask = attention_mask[..., None].astype(np.float32)
+        summed = (hidden * mask).sum(axis=1)
+        return summed / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    def encode(self, sentences, batch_size: int = 32, show_progress_bar: bool = False,
+               convert_to_numpy: bool = True, normalize_embeddings: bool = True, **kwargs):
+        """Encode a string or list of strings. Returns float32 array of shape (N, dim) or (dim,)."""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        parts = [self._embed_batch(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)]
+        embeddings = np.concatenate(parts).astype(np.float32, copy=False)
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12
+        return embeddings[0] if single else embeddings
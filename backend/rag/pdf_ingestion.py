@@ -8,38 +8,58 @@ generates embeddings, and stores in the manual_chunks table.
 import os
 import re
 import io
+import multiprocessing
+from bisect import bisect_right
 import fitz  # PyMuPDF
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
+# Gemini image descriptions are network-bound; issue this many at once
+IMAGE_DESCRIBE_WORKERS = 8
 
-def extract_pages(pdf_path: str):
-    """
-    Extract text and images from each page of a PDF.
-    Returns list of dicts: [{page_number, text, images: [bytes]}]
-    """
+# Page extraction is CPU-bound; fan out across processes for PDFs with enough pages to amortize startup
+EXTRACT_MAX_WORKERS = 8
+EXTRACT_MIN_PAGES_PER_WORKER = 25
+
+# Figures are sent to Gemini as JPEG; far smaller than PNG with no loss in description quality
+IMAGE_JPEG_QUALITY = 85
+
+
+def _extract_page_range(pdf_path: str, start: int, stop: int, include_images: bool = True):
+    """Extract pages [start, stop) from their own Document; fitz handles aren't shareable across processes."""
     doc = fitz.open(pdf_path)
     pages = []
 
-    for page_num in range(len(doc)):
+    for page_num in range(start, stop):
         page = doc[page_num]
 
         # Extract text with layout preservation
         text = page.get_text("text")
 
-        # Extract images
+        # Extract images (only rasterized when a caller will describe them)
         images = []
-        for img_info in page.get_images(full=True):
-            xref = img_info[0]
+        for img_info in (page.get_images(full=True) if include_images else ()):
+            # (xref, smask, width, height, bpc, colorspace, alt_colorspace, name, filter, ...)
+            xref, smask, width, height = img_info[:4]
+            colorspace, image_filter = img_info[5], img_info[8]
+            # Skip tiny images (icons, bullets, etc.) from the image dictionary, before decoding
+            if width < 100 or height < 100:
+                continue
             try:
-                pix = fitz.Pixmap(doc, xref)
-                # Skip tiny images (icons, bullets, etc.)
-                if pix.width < 100 or pix.height < 100:
-                    pix = None
+                if (image_filter == "DCTDecode" and not smask
+                        and colorspace in ("DeviceRGB", "DeviceGray")):
+                    # Already a plain JPEG in the PDF: pass the stream through undecoded
+                    images.append(doc.xref_stream_raw(xref))
                     continue
+                pix = fitz.Pixmap(doc, xref)
                 # Convert CMYK to RGB if needed
                 if pix.n > 4:
                     pix = fitz.Pixmap(fitz.csRGB, pix)
-                img_bytes = pix.tobytes("png")
+                # JPEG has no alpha channel
+                if pix.alpha:
+                    pix = fitz.Pixmap(pix, 0)
+                img_bytes = pix.tobytes("jpg", jpg_quality=IMAGE_JPEG_QUALITY)
                 images.append(img_bytes)
                 pix = None
             except Exception as e:
@@ -55,6 +75,35 @@ def extract_pages(pdf_path: str):
     return pages
 
 
+def extract_pages(pdf_path: str, include_images: bool = True):
+    """
+    Extract text and images from each page of a PDF.
+    Large PDFs are split into page ranges extracted in parallel worker processes.
+    With include_images=False no pixmaps are decoded and every page's images list is empty.
+    Returns list of dicts: [{page_number, text, images: [JPEG bytes]}]
+    """
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+
+    workers = min(os.cpu_count() or 1, EXTRACT_MAX_WORKERS, page_count // EXTRACT_MIN_PAGES_PER_WORKER)
+    if workers <= 1:
+        return _extract_page_range(pdf_path, 0, page_count, include_images)
+
+    bounds = [page_count * i // workers for i in range(workers + 1)]
+    # Spawned, not forked: by now this process runs numba, ONNX/torch and logging threads, and a
+    # forked child can inherit one of their locks mid-acquire and deadlock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(_extract_page_range, pdf_path, start, stop, include_images)
+                   for start, stop in zip(bounds, bounds[1:])]
+        # Ranges are contiguous and submitted in order, so results are already page-ordered
+        return [page for future in futures for page in future.result()]
+
+
+_WORD_RE = re.compile(r'\S+')
+# Period followed by any whitespace: PDF text usually ends sentences with ".\n"
+_SENTENCE_BREAK_RE = re.compile(r'\.\s')
+
+
 def detect_section_title(text: str):
     """Try to detect a section heading from the start of a text block."""
     lines = text.strip().split('\n')
@@ -81,9 +130,12 @@ def chunk_text(text: str, page_number: int, max_tokens: int = 800, overlap_token
     if not text.strip():
         return []
 
-    # Approximate tokens as words
-    words = text.split()
-    if len(words) <= max_tokens:
+    # Approximate tokens as words; chunks are sliced straight out of text by word offsets
+    word_spans = [m.span() for m in _WORD_RE.finditer(text)]
+    starts = [span[0] for span in word_spans]
+    ends = [span[1] for span in word_spans]
+    n_words = len(word_spans)
+    if n_words <= max_tokens:
         return [{
             'text': text.strip(),
             'page_number': page_number,
@@ -93,21 +145,22 @@ def chunk_text(text: str, page_number: int, max_tokens: int = 800, overlap_token
 
     chunks = []
     start = 0
-    while start < len(words):
-        end = min(start + max_tokens, len(words))
+    while start < n_words:
+        end = min(start + max_tokens, n_words)
 
         # Try to break at a sentence boundary (period followed by space/newline)
-        if end < len(words):
-            chunk_text_str = ' '.join(words[start:end])
+        if end < n_words:
+            chunk_start, chunk_end = starts[start], ends[end - 1]
             # Look for last sentence break in the last 20% of the chunk
-            search_start = int(len(chunk_text_str) * 0.8)
-            last_period = chunk_text_str.rfind('. ', search_start)
-            if last_period > 0:
-                # Recalculate end based on the sentence break
-                trimmed = chunk_text_str[:last_period + 1]
-                end = start + len(trimmed.split())
-
-        chunk_str = ' '.join(words[start:end]).strip()
+            search_start = chunk_start + int((chunk_end - chunk_start) * 0.8)
+            last_period = -1
+            for match in _SENTENCE_BREAK_RE.finditer(text, search_start, chunk_end):
+                last_period = match.start()
+            if last_period > chunk_start:
+                # Recalculate end: the word ending with that period closes the chunk
+                end = bisect_right(ends, last_period + 1, start, end)
+
+        chunk_str = text[starts[start]:ends[end - 1]]
         if chunk_str:
             chunks.append({
                 'text': chunk_str,
@@ -116,19 +169,26 @@ def chunk_text(text: str, page_number: int, max_tokens: int = 800, overlap_token
                 'chunk_type': 'text',
             })
 
-        start = end - overlap_tokens if end < len(words) else len(words)
+        start = end - overlap_tokens if end < n_words else n_words
 
     return chunks
 
 
+@lru_cache(maxsize=1)
+def get_vision_model(api_key: str):
+    """Configure Gemini once; worker threads share the model instead of reconfiguring per image."""
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel('gemini-2.5-flash')
+
+
 def describe_image_with_gemini(image_bytes: bytes, api_key: str, page_number: int):
     """Use Gemini to generate a text description of an image."""
     try:
-        import google.generativeai as genai
         from PIL import Image
 
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash')
+        model = get_vision_model(api_key)
 
         img = Image.open(io.BytesIO(image_bytes))
 
@@ -163,8 +223,8 @@ def process_pdf(pdf_path: str, manual_id: int, describe_images: bool = True):
     Returns:
         Number of chunks created
     """
-    from rag.vector_store import generate_embedding
-    from rag.db import save_manual_chunk, delete_chunks_by_manual
+    from rag.vector_store import generate_embeddings_batch
+    from rag.db import save_manual_chunks_bulk, delete_chunks_by_manual
 
     api_key = os.getenv("GEMINI_API_KEY") if describe_images else None
     if describe_images and not api_key:
@@ -175,10 +235,13 @@ def process_pdf(pdf_path: str, manual_id: int, describe_images: bool = True):
     delete_chunks_by_manual(manual_id)
 
     print(f"  Extracting pages from {pdf_path}...")
-    pages = extract_pages(pdf_path)
+    pages = extract_pages(pdf_path, include_images=describe_images)
     print(f"  Extracted {len(pages)} pages")
 
-    total_chunks = 0
+    # (chunk_text, page_number, section_title, chunk_type); embedded in one batch at the end
+    pending = []
+    # (page_number, image_bytes) to describe concurrently after the text pass
+    image_jobs = []
 
     for page in pages:
         page_num = page['page_number']
@@ -188,36 +251,35 @@ def process_pdf(pdf_path: str, manual_id: int, describe_images: bool = True):
         for chunk in text_chunks:
             if len(chunk['text'].split()) < 5:
                 continue  # Skip very short chunks
-            embedding = generate_embedding(chunk['text'])
-            save_manual_chunk(
-                manual_id=manual_id,
-                chunk_text=chunk['text'],
-                embedding=embedding,
-                page_number=chunk['page_number'],
-                section_title=chunk['section_title'],
-                chunk_type=chunk['chunk_type'],
-            )
-            total_chunks += 1
-
-        # Describe images and store as chunks
+            pending.append((chunk['text'], chunk['page_number'],
+                            chunk['section_title'], chunk['chunk_type']))
+
         if describe_images and page['images']:
-            for i, img_bytes in enumerate(page['images']):
-                description = describe_image_with_gemini(img_bytes, api_key, page_num)
-                if description:
-                    prefixed = f"[Image from page {page_num}]: {description}"
-                    embedding = generate_embedding(prefixed)
-                    save_manual_chunk(
-                        manual_id=manual_id,
-                        chunk_text=prefixed,
-                        embedding=embedding,
-                        page_number=page_num,
-                        section_title=None,
-                        chunk_type='image_description',
-                    )
-                    total_chunks += 1
+            image_jobs.extend((page_num, img_bytes) for img_bytes in page['images'])
 
         if page_num % 50 == 0:
             print(f"  Processed page {page_num}/{len(pages)}...")
 
+    # Describe images and store as chunks
+    if image_jobs:
+        print(f"  Describing {len(image_jobs)} images...")
+        with ThreadPoolExecutor(max_workers=IMAGE_DESCRIBE_WORKERS) as executor:
+            futures = [executor.submit(describe_image_with_gemini, img_bytes, api_key, page_num)
+                       for page_num, img_bytes in image_jobs]
+            descriptions = [f.result() for f in futures]
+        for (page_num, _), description in zip(image_jobs, descriptions):
+            if description:
+                prefixed = f"[Image from page {page_num}]: {description}"
+                pending.append((prefixed, page_num, None, 'image_description'))
+
+    # One batched encode for the whole manual instead of a forward pass per chunk
+    total_chunks = 0
+    if pending:
+        print(f"  Embedding {len(pending)} chunks...")
+        embeddings = generate_embeddings_batch([text for text, _, _, _ in pending])
+        rows = [(text, embedding, page_number, section_title, chunk_type)
+                for (text, page_number, section_title, chunk_type), embedding in zip(pending, embeddings)]
+        total_chunks = save_manual_chunks_bulk(manual_id, rows)
+
     print(f"  Done: {total_chunks} chunks created for manual_id={manual_id}")
     return total_chunks
@@ -1,181 +1,597 @@
-import os, re
-from datetime import datetime
-from rank_bm25 import BM25Okapi
+import os
+import logging
+import json
+import shutil
+import tempfile
 from pathlib import Path
+from functools import lru_cache
 import threading
+import time
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from rag.db import (
+    get_all_notes_for_bm25, get_all_chunks_for_bm25, get_notes_by_ids, get_chunks_by_ids,
+    search_similar_union,
+    hybrid_search, get_index_version,
+)
+from rag.bm25_nb import NUMBA_AVAILABLE, bm25_score_njit
+from rag.bm25_tokens import tokenize, encode_tokens, encode_shard
+
+logger = logging.getLogger(__name__)
+
+# Keyword half of hybrid search:
+#   "bm25"     - in-process BM25 index over notes + manual chunks (default)
+#   "postgres" - ts_rank_cd over GIN-indexed tsvector columns, fused with the vector
+#                score in a single SQL query (rag.db.hybrid_search)
+KEYWORD_BACKEND = os.getenv("KEYWORD_BACKEND", "bm25")
+
+MODELS_DIR = Path(__file__).resolve().parent.parent / "models"
+ONNX_MODEL_DIR = MODELS_DIR / "all-MiniLM-L6-v2-onnx"
+
+def _load_onnx_embedder():
+    """Use the exported ONNX model when present; returns None to fall back to PyTorch."""
+    from rag.onnx_embedder import OnnxEmbedder, find_onnx_model
+
+    if not find_onnx_model(str(ONNX_MODEL_DIR)):
+        return None
+    try:
+        embedder = OnnxEmbedder(ONNX_MODEL_DIR)
+    except ImportError as e:
+        logger.warning("ONNX model found but onnxruntime unavailable (%s); using PyTorch", e)
+        return None
+    logger.info("Loaded ONNX embedder from: %s", embedder.model_path)
+    return embedder
 
 # Lazy-load to avoid heavy import cost at container boot
 _embedder = None
+# Identifies the loaded model (file path or hub name); part of the query-embedding cache key
+_embedder_version = None
+# Background load started at import when WARM_EMBEDDER=1 (see below)
+_warmup = None
 def get_embedder():
-    global _embedder
+    global _embedder, _embedder_version
+    if _warmup is not None and _warmup is not threading.current_thread() and _warmup.is_alive():
+        # Warmup is mid-load: wait for it instead of loading a second copy
+        _warmup.join()
     if _embedder is None:
+        _embedder = _load_onnx_embedder()
+        if _embedder is not None:
+            _embedder_version = _embedder.model_path
+
+    if _embedder is None:
+        import torch
         from sentence_transformers import SentenceTransformer
 
-        current_file = Path(__file__).resolve()
-        backend_dir = current_file.parent.parent
-        local_model_path = backend_dir / "models" / "all-MiniLM-L6-v2"
+        # Use every core for the CPU forward pass; one inter-op thread since encode runs one graph
+        torch.set_num_threads(max(1, os.cpu_count() or 1))
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:  # only settable before torch has run any parallel work
+            pass
+
+        local_model_path = MODELS_DIR / "all-MiniLM-L6-v2"
 
         if local_model_path.exists():
-            print(f"Loading model from: {local_model_path}")
+            logger.info("Loading model from: %s", local_model_path)
             _embedder = SentenceTransformer(str(local_model_path))
-            print("Model loaded from local path")
+            _embedder_version = str(local_model_path)
+            logger.info("Model loaded from local path")
         else:
-            print("Local model not found, downloading from HuggingFace")
+            logger.info("Local model not found, downloading from HuggingFace")
             _embedder = SentenceTransformer("all-MiniLM-L6-v2")
+            _embedder_version = "all-MiniLM-L6-v2"
 
     return _embedder
 
+def _warm_embedder():
+    try:
+        get_embedder()
+        logger.info("Embedder warmed up")
+    except Exception as e:
+        logger.warning("Embedder warmup failed, loading on first use instead: %s", e)
+
+# Overlap the 2-10 s model load with container start-up instead of the first query
+if os.getenv("WARM_EMBEDDER") == "1":
+    _warmup = threading.Thread(target=_warm_embedder, name="embedder-warmup", daemon=True)
+    _warmup.start()
+
 def generate_embedding(text: str):
     """Generate embedding for the given text."""
     embedder = get_embedder()
-    embedding = embedder.encode([text])[0].tolist()
+    embedding = embedder.encode([text], normalize_embeddings=True)[0].tolist()
     return embedding
 
-_bm25_data = {'bm25': None, 'docs': [], 'metas': [], 'machine_id': None}
-_bm25_lock = threading.Lock()
+# all-MiniLM-L6-v2 lowercases its input, so case-folding the key doesn't change the embedding
+QUERY_EMBEDDING_CACHE_SIZE = 2048
 
-def load_bm25_index(machine_id: int = None):
-    """Build BM25 index from notes + manual chunks, optionally filtered by machine."""
-    global _bm25_data
-
-    with _bm25_lock:
-        try:
-            from rag.db import get_all_notes_for_bm25, get_all_chunks_for_bm25
-
-            notes = get_all_notes_for_bm25(machine_id)
-            chunks = get_all_chunks_for_bm25(machine_id)
-
-            docs = []
-            metas = []
-
-            # Add notes
-            for note in notes:
-                docs.append(note['text'])
-                metas.append({
-                    'source_type': 'note',
-                    'note_id': str(note['id']),
-                    'created_at': str(note['created_at']),
-                })
-
-            # Add manual chunks
-            for chunk in chunks:
-                docs.append(chunk['chunk_text'])
-                metas.append({
-                    'source_type': 'manual',
-                    'chunk_id': str(chunk['id']),
-                    'manual_title': chunk['manual_title'],
-                    'page_number': chunk.get('page_number'),
-                    'section_title': chunk.get('section_title'),
-                    'chunk_type': chunk.get('chunk_type', 'text'),
-                })
-
-            if not docs:
-                _bm25_data = {'bm25': BM25Okapi([[]]), 'docs': [], 'metas': [], 'machine_id': machine_id}
-                print(f"BM25 index built with 0 documents (machine_id={machine_id})")
-                return
-
-            tokenized = [re.findall(r"\w+", doc.lower()) for doc in docs]
-            _bm25_data = {
-                'bm25': BM25Okapi(tokenized),
-                'docs': docs,
-                'metas': metas,
-                'machine_id': machine_id,
-            }
-
-            print(f"BM25 index built: {len(notes)} notes + {len(chunks)} manual chunks (machine_id={machine_id})")
-        except Exception as e:
-            print(f"Error building BM25 index: {e}")
-            _bm25_data = {'bm25': BM25Okapi([[]]), 'docs': [], 'metas': [], 'machine_id': machine_id}
+@lru_cache(maxsize=QUERY_EMBEDDING_CACHE_SIZE)
+def _encode_query_cached(text_norm: str, model_version: str) -> tuple:
+    return tuple(get_embedder().encode([text_norm], normalize_embeddings=True)[0].tolist())
 
+def generate_query_embedding(query: str):
+    """
+    Embedding for a search query, memoized so repeated questions skip the forward pass.
+    Keyed by model version too, so a swapped model never serves the old model's vectors.
+    """
+    get_embedder()
+    return list(_encode_query_cached(query.strip().lower(), _embedder_version))
 
-def hybrid_retrieve(query: str, top_k: int = 5, alpha: float = 0.6, machine_id: int = None):
-    """Retrieve documents using hybrid BM25 + vector similarity from both notes and manual chunks."""
-    from rag.db import search_similar_notes, search_similar_chunks
+def generate_embeddings_batch(texts: list, batch_size: int = 64, show_progress_bar: bool = False):
+    """Generate embeddings for many texts with one batched encode call. Returns an (N, 384) array."""
+    embedder = get_embedder()
+    return embedder.encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar,
+                           convert_to_numpy=True, normalize_embeddings=True)
+
+# Appended docs are folded into the scorer after this many, or by the next query after this long
+BM25_REBUILD_EVERY_DOCS = 64
+BM25_REBUILD_EVERY_SECONDS = 30
+
+# BM25Okapi parameters (rank_bm25 defaults)
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+
+# "numba" (default when installed) or "numpy" score the CSR arrays; "rank_bm25" keeps the
+# reference BM25Okapi implementation as a cold fallback
+BM25_SCORER = os.getenv("BM25_SCORER", "numba" if NUMBA_AVAILABLE else "numpy")
+
+# Per-machine BM25 indexes kept warm; each is checked against get_index_version at most this often
+BM25_CACHE_MACHINES = 8
+BM25_VERSION_CHECK_SECONDS = 5
+
+# Opt-in: when set (to persistent storage; Cloud Run's /tmp is RAM and gone on restart), built
+# indexes are snapshotted here as .npy files (memory-mapped on load) keyed by machine and
+# get_index_version, so a restart with unchanged tables skips the DB read and re-tokenizing
+BM25_CACHE_DIR = os.getenv("BM25_CACHE_DIR", "")
+
+# source_types values; doc i's hybrid-merge key is _KEY_PREFIX[source_types[i]] + str(ids[i])
+SOURCE_NOTE = 0
+SOURCE_CHUNK = 1
+_KEY_PREFIX = ("note_", "chunk_")
+
+def _empty_bm25_data(machine_id=None, version=None):
+    # Documents are token-id runs: doc i is term_ids[sum(doc_lens[:i]):][:doc_lens[i]], ids from
+    # vocab. Notes appended since the last rebuild wait in pending as one id array each.
+    # source_types[i] / ids[i] identify doc i (built docs first, then pending); text and display
+    # metadata aren't held in memory, only fetched for hits that make the top_k.
+    # bm25 is the CSR index arrays (_build_bm25_arrays), or a BM25Okapi for BM25_SCORER=rank_bm25.
+    return {'bm25': None, 'source_types': np.zeros(0, dtype=np.uint8), 'ids': np.zeros(0, dtype=np.int64),
+            'vocab': {}, 'term_ids': np.zeros(0, dtype=np.int32), 'doc_lens': np.zeros(0, dtype=np.int64),
+            'pending': [], 'machine_id': machine_id,
+            'built_docs': 0, 'built_at': 0.0, 'version': version, 'checked_at': time.monotonic()}
+
+# machine_id -> index bundle, least recently used first
+_bm25_by_machine = OrderedDict()
+_bm25_lock = threading.Lock()
 
-    # Rebuild BM25 if machine changed or not initialized
-    if _bm25_data['bm25'] is None or _bm25_data.get('machine_id') != machine_id:
-        load_bm25_index(machine_id)
+# Full rebuilds tokenize in worker processes above this many documents
+BM25_PARALLEL_MIN_DOCS = 2000
+BM25_TOKENIZE_MAX_WORKERS = 8
+
+# Spawned (not forked: this process runs logging, embedder and numba threads) on first use and
+# kept, so later rebuilds don't pay interpreter start-up again
+_tokenize_executor = None
+_tokenize_executor_lock = threading.Lock()
+
+def _get_tokenize_executor(workers: int) -> ProcessPoolExecutor:
+    global _tokenize_executor
+    with _tokenize_executor_lock:
+        if _tokenize_executor is None:
+            _tokenize_executor = ProcessPoolExecutor(max_workers=workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+        return _tokenize_executor
+
+def _encode_corpus(texts: list, vocab: dict):
+    """
+    Term ids (int32, all texts concatenated) and per-text token counts, adding terms to vocab.
+    Large corpora are sharded across worker processes; each shard's local ids are relabelled
+    into vocab.
+    """
+    workers = min(os.cpu_count() or 1, BM25_TOKENIZE_MAX_WORKERS)
+    if len(texts) <= BM25_PARALLEL_MIN_DOCS or workers <= 1:
+        shards = [encode_shard(texts)]
+    else:
+        bounds = [len(texts) * i // workers for i in range(workers + 1)]
+        executor = _get_tokenize_executor(workers)
+        # Shards are contiguous and collected in submission order, so ids stay aligned with texts
+        futures = [executor.submit(encode_shard, texts[start:stop]) for start, stop in zip(bounds, bounds[1:])]
+        shards = [future.result() for future in futures]
+
+    term_ids, doc_lens = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int64)]
+    for terms, local_ids, lens in shards:
+        term_ids.append(encode_tokens(terms, vocab)[local_ids])
+        doc_lens.append(lens)
+    return np.concatenate(term_ids), np.concatenate(doc_lens)
+
+def _build_bm25_arrays(term_ids: np.ndarray, doc_len: np.ndarray, n_terms: int) -> dict:
+    """
+    Doc-major CSR term frequencies plus corpus statistics, same math as BM25Okapi:
+    row d spans indices/tf[indptr[d]:indptr[d+1]], term ids sorted within each row.
+    """
+    n_docs, n_terms = len(doc_len), max(n_terms, 1)
+
+    # One (doc, term) code per token; np.unique sorts doc-major and counts term frequencies
+    doc_ids = np.repeat(np.arange(n_docs, dtype=np.int64), doc_len)
+    pairs, tf = np.unique(doc_ids * n_terms + term_ids, return_counts=True)
+    indices = (pairs % n_terms).astype(np.int32)
+    indptr = np.zeros(n_docs + 1, dtype=np.int64)
+    rows = (pairs // n_terms).astype(np.int32)
+    np.cumsum(np.bincount(rows, minlength=n_docs), out=indptr[1:])
+
+    df = np.bincount(indices, minlength=n_terms)
+    idf = np.log((n_docs - df + 0.5) / (df + 0.5))
+    if len(indices):
+        # BM25Okapi floors negative idf (terms in more than half the docs) at epsilon * mean idf
+        idf[idf < 0] = BM25_EPSILON * idf.mean()
+
+    return {
+        'indptr': indptr,
+        'indices': indices,
+        'rows': rows,  # doc id of each CSR entry, for the NumPy scorer
+        'tf': tf.astype(np.float64),
+        'doc_len': doc_len.astype(np.float64),
+        'idf': idf,
+        'avgdl': float(doc_len.mean()) if n_docs and doc_len.sum() else 1.0,
+    }
+
+def _bm25_scores_numpy(q_ids: np.ndarray, index: dict, n_docs: int) -> np.ndarray:
+    """Vectorized BM25: gather the CSR entries of the query terms and sum them per document."""
+    q_terms, q_counts = np.unique(q_ids, return_counts=True)
+    pos = np.flatnonzero(np.isin(index['indices'], q_terms))
+    terms = index['indices'][pos]
+    rows = index['rows'][pos]
+    tf = index['tf'][pos]
+
+    denom = tf + BM25_K1 * (1 - BM25_B + BM25_B * index['doc_len'][rows] / index['avgdl'])
+    contrib = (q_counts[np.searchsorted(q_terms, terms)] * index['idf'][terms]
+               * tf * (BM25_K1 + 1) / denom)
+    return np.bincount(rows, weights=contrib, minlength=n_docs)
+
+def _rebuild_bm25_locked(data: dict):
+    """
+    Fold pending notes into the token arrays and rebuild the BM25 scorer of data.
+    Caller holds _bm25_lock, or owns data before it is published to _bm25_by_machine.
+    """
+    if data['pending']:
+        data['term_ids'] = np.concatenate([data['term_ids']] + data['pending'])
+        data['doc_lens'] = np.concatenate([data['doc_lens'], [len(ids) for ids in data['pending']]])
+        data['pending'] = []
+    if BM25_SCORER == "rank_bm25":
+        # Imported here: only this opt-in fallback needs rank_bm25
+        from rank_bm25 import BM25Okapi
+
+        docs = np.split(data['term_ids'], np.cumsum(data['doc_lens'])[:-1]) if len(data['doc_lens']) else []
+        data['bm25'] = BM25Okapi([doc.tolist() for doc in docs] or [[]])
+    else:
+        data['bm25'] = _build_bm25_arrays(data['term_ids'], data['doc_lens'], len(data['vocab']))
+    data['built_docs'] = len(data['doc_lens'])
+    data['built_at'] = time.monotonic()
+
+def _bm25_get_scores(data: dict, query_tokens: list) -> np.ndarray:
+    """BM25 score of every document the current scorer was built over, for the query tokens."""
+    vocab = data['vocab']
+    # Repeated query terms count repeatedly, as in BM25Okapi.get_scores
+    q_ids = [vocab[t] for t in query_tokens if t in vocab]
+    # Read the scorer once and size everything from it: a concurrent rebuild (note save) swaps
+    # data['bm25'] before it updates built_docs, and queries don't hold _bm25_lock
+    index = data['bm25']
+    if not isinstance(index, dict):
+        return index.get_scores(q_ids)
+    n_docs = index['doc_len'].shape[0]
+    if not n_docs:
+        return np.zeros(0)
+    # Terms first seen in pending notes have no idf entry yet and match no built document
+    q_ids = np.asarray([t for t in q_ids if t < len(index['idf'])], dtype=np.int32)
+    if BM25_SCORER == "numpy":
+        return _bm25_scores_numpy(q_ids, index, n_docs)
+    scores = np.empty(n_docs, dtype=np.float32)
+    # The kernel writes scores[d] for every document without bounds checks
+    assert scores.shape[0] >= index['doc_len'].shape[0]
+    bm25_score_njit(q_ids, index['idf'], index['tf'], index['indptr'], index['indices'],
+                    index['doc_len'], index['avgdl'], BM25_K1, BM25_B, scores)
+    return scores
+
+# Bundle arrays persisted in a snapshot; the CSR scorer arrays are added when BM25_SCORER uses them
+_SNAPSHOT_ARRAYS = ('source_types', 'ids', 'term_ids', 'doc_lens')
+_SNAPSHOT_INDEX_ARRAYS = ('indptr', 'indices', 'rows', 'tf', 'doc_len', 'idf')
+
+def _snapshot_prefix(machine_id) -> str:
+    return f"bm25_{'all' if machine_id is None else machine_id}_"
+
+def _snapshot_path(machine_id, version) -> str:
+    return os.path.join(BM25_CACHE_DIR, _snapshot_prefix(machine_id) + "_".join(str(v) for v in version))
+
+def _cache_dir_is_private() -> bool:
+    """Only trust snapshots in a directory this user owns and nobody else can write to."""
+    st = os.stat(BM25_CACHE_DIR)
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+def _load_bm25_snapshot(machine_id, version):
+    """Bundle from the snapshot of (machine_id, version), or None when there isn't one."""
+    path = _snapshot_path(machine_id, version)
+    if not os.path.isdir(path):
+        return None
+    if not _cache_dir_is_private():
+        logger.warning("Ignoring BM25 snapshots: %s is writable by other users", BM25_CACHE_DIR)
+        return None
+    data = _empty_bm25_data(machine_id, version)
+    # Read-only memory maps: rebuilds and appends make new arrays, nothing writes in place
+    for name in _SNAPSHOT_ARRAYS:
+        data[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+    # Plain data only (np.load refuses pickled arrays by default, meta is JSON)
+    with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    data['vocab'] = {term: i for i, term in enumerate(meta['terms'])}
+
+    if BM25_SCORER != "rank_bm25" and 'avgdl' in meta:
+        index = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in _SNAPSHOT_INDEX_ARRAYS}
+        index['avgdl'] = meta['avgdl']
+        data['bm25'] = index
+        data['built_docs'] = len(data['doc_lens'])
+        data['built_at'] = time.monotonic()
+    else:
+        _rebuild_bm25_locked(data)
+    return data
+
+def _save_bm25_snapshot(data: dict):
+    """Write data's snapshot and drop older ones for the same machine. Best effort."""
+    os.makedirs(BM25_CACHE_DIR, mode=0o700, exist_ok=True)
+    if not _cache_dir_is_private():
+        raise OSError(f"{BM25_CACHE_DIR} is writable by other users")
+    path = _snapshot_path(data['machine_id'], data['version'])
+    tmp_path = tempfile.mkdtemp(dir=BM25_CACHE_DIR, prefix=".tmp_")
+    try:
+        # vocab is insertion-ordered with ids 0..n-1, so the term list alone rebuilds it
+        meta = {'terms': list(data['vocab'])}
+        for name in _SNAPSHOT_ARRAYS:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), data[name])
+        if isinstance(data['bm25'], dict):
+            for name in _SNAPSHOT_INDEX_ARRAYS:
+                np.save(os.path.join(tmp_path, f"{name}.npy"), data['bm25'][name])
+            meta['avgdl'] = data['bm25']['avgdl']
+        with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        # Atomic publish; another worker process may have published the same version first
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+
+    prefix = _snapshot_prefix(data['machine_id'])
+    for name in os.listdir(BM25_CACHE_DIR):
+        if name.startswith(prefix) and os.path.join(BM25_CACHE_DIR, name) != path:
+            shutil.rmtree(os.path.join(BM25_CACHE_DIR, name), ignore_errors=True)
+
+def _build_bm25_bundle(machine_id: int = None) -> dict:
+    """Build a fresh index bundle from the DB. Runs without _bm25_lock; nothing else sees it yet."""
+    # Read the version first: rows written while we load bump it past what we record
+    version = get_index_version()
+    if BM25_CACHE_DIR:
+        try:
+            data = _load_bm25_snapshot(machine_id, version)
+            if data is not None:
+                logger.info("BM25 index loaded from snapshot: %d docs (machine_id=%s)", len(data['ids']), machine_id)
+                return data
+        except Exception as e:
+            logger.warning("Unreadable BM25 snapshot, rebuilding: %s", e)
 
-    query_embedding = generate_embedding(query)
+    notes = get_all_notes_for_bm25(machine_id)
+    chunks = get_all_chunks_for_bm25(machine_id)
 
-    # Semantic search across both sources
-    note_results = search_similar_notes(query_embedding, top_k=top_k * 2, machine_id=machine_id)
-    chunk_results = search_similar_chunks(query_embedding, top_k=top_k * 2, machine_id=machine_id)
+    data = _empty_bm25_data(machine_id, version)
+    n_docs = len(notes) + len(chunks)
+    data['source_types'] = np.full(n_docs, SOURCE_CHUNK, dtype=np.uint8)
+    data['source_types'][:len(notes)] = SOURCE_NOTE
+    data['ids'] = np.fromiter((row_id for row_id, _ in notes + chunks), dtype=np.int64, count=n_docs)
+    data['term_ids'], data['doc_lens'] = _encode_corpus([text for _, text in notes + chunks], data['vocab'])
+    _rebuild_bm25_locked(data)
 
-    # BM25 keyword search
-    query_tokens = re.findall(r"\w+", query.lower())
+    logger.info("BM25 index built: %d notes + %d manual chunks (machine_id=%s)", len(notes), len(chunks), machine_id)
+    if BM25_CACHE_DIR:
+        try:
+            _save_bm25_snapshot(data)
+        except Exception as e:
+            logger.warning("Could not write BM25 snapshot: %s", e)
+    return data
+
+
+def load_bm25_index(machine_id: int = None) -> dict:
+    """
+    Build BM25 index from notes + manual chunks, optionally filtered by machine.
+    The DB reads and tokenization run outside _bm25_lock, so queries against other cached
+    indexes and note saves aren't blocked behind a rebuild.
+    """
+    try:
+        data = _build_bm25_bundle(machine_id)
+    except Exception as e:
+        logger.error("Error building BM25 index: %s", e)
+        data = _empty_bm25_data(machine_id)
+        _rebuild_bm25_locked(data)
+        return data
 
-    bm25_scores = []
-    if _bm25_data['docs']:
-        bm25_scores = _bm25_data['bm25'].get_scores(query_tokens)
-        max_bm25 = max(bm25_scores) if max(bm25_scores) > 0 else 1.0
-        bm25_norm = [s / max_bm25 for s in bm25_scores]
+    with _bm25_lock:
+        _bm25_by_machine[machine_id] = data
+        _bm25_by_machine.move_to_end(machine_id)
+        while len(_bm25_by_machine) > BM25_CACHE_MACHINES:
+            _bm25_by_machine.popitem(last=False)
+    return data
+
+
+def get_bm25_index(machine_id: int = None) -> dict:
+    """
+    Cached index for machine_id. Rebuilt only when get_index_version moves past the version it
+    was built at (new notes or re-ingested manuals), not on every switch between machines.
+    """
+    with _bm25_lock:
+        data = _bm25_by_machine.get(machine_id)
+        if data is not None:
+            now = time.monotonic()
+            if now - data['checked_at'] >= BM25_VERSION_CHECK_SECONDS:
+                data['checked_at'] = now
+                try:
+                    if get_index_version() != data['version']:
+                        data = None
+                except Exception as e:
+                    logger.warning("BM25 index version check failed, serving cached index: %s", e)
+
+        if data is not None:
+            _bm25_by_machine.move_to_end(machine_id)
+            _refresh_bm25_if_stale_locked(data)
+            return data
+
+    return load_bm25_index(machine_id)
+
+
+def add_note_to_bm25(note_id: int, text: str, machine_id: int = None):
+    """
+    Append a newly saved note to every cached index that covers it, without re-reading the DB.
+    Only the note is tokenized; the scorer is rebuilt from cached token ids every
+    BM25_REBUILD_EVERY_DOCS appends (or lazily by the next stale query).
+    """
+    with _bm25_lock:
+        tokens = None
+        for data in _bm25_by_machine.values():
+            # Still current if this note is the only row written since the bundle was built
+            # (ids are sequential); anything else is picked up by the next version check
+            version = data['version']
+            if version is not None and (version[0] or 0) >= note_id:
+                # Rebuilt after the note was committed (the version check can fire between
+                # insert_note_text and this call), so it is already indexed
+                continue
+            if version is not None and (version[0] or 0) == note_id - 1:
+                data['version'] = (note_id,) + tuple(version[1:])
+
+            # Machine-scoped indexes hold that machine's notes plus unassigned ones
+            if data['machine_id'] is not None and machine_id is not None and machine_id != data['machine_id']:
+                continue
+            # A rebuild whose version read raced the insert can hold the row under an older version
+            if np.any((data['ids'] == note_id) & (data['source_types'] == SOURCE_NOTE)):
+                continue
+
+            if tokens is None:
+                tokens = tokenize(text)
+            data['source_types'] = np.append(data['source_types'], np.uint8(SOURCE_NOTE))
+            data['ids'] = np.append(data['ids'], np.int64(note_id))
+            data['pending'].append(encode_tokens(tokens, data['vocab']))
+
+            if len(data['pending']) >= BM25_REBUILD_EVERY_DOCS:
+                _rebuild_bm25_locked(data)
+
+
+def _refresh_bm25_if_stale_locked(data: dict):
+    """Fold appended docs into the scorer once enough have piled up or they've waited long enough."""
+    pending = len(data['pending'])
+    if pending and (pending >= BM25_REBUILD_EVERY_DOCS
+                    or time.monotonic() - data['built_at'] >= BM25_REBUILD_EVERY_SECONDS):
+        _rebuild_bm25_locked(data)
+
+
+def _note_entry(row, sem=0.0, bm25=0.0):
+    return {
+        'text': row['text'],
+        'source_type': 'note',
+        'note_id': str(row['id']),
+        'created_at': str(row['created_at']),
+        'sem': sem,
+        'bm25': bm25,
+    }
+
+
+def _chunk_entry(row, sem=0.0, bm25=0.0):
+    return {
+        'text': row['chunk_text'],
+        'source_type': 'manual',
+        'manual_title': row['manual_title'],
+        'page_number': row.get('page_number'),
+        'section_title': row.get('section_title'),
+        'chunk_type': row.get('chunk_type', 'text'),
+        'sem': sem,
+        'bm25': bm25,
+    }
+
+
+def _bm25_matches(data: dict, query: str):
+    """
+    Merge keys of the in-process BM25 index's matching documents and their scores
+    normalized to the best match.
+    """
+    if not len(data['ids']):
+        return [], np.zeros(0)
+    bm25_scores = np.asarray(_bm25_get_scores(data, tokenize(query)), dtype=np.float64)
+    if not len(bm25_scores):
+        return [], np.zeros(0)
+    max_bm25 = bm25_scores.max()
+
+    # A document without any query term scores exactly 0, so keep only the matches (the scores
+    # are sparse in the query terms); they line up with the first built_docs rows of the arrays
+    hits = np.flatnonzero(bm25_scores)
+    hit_scores = bm25_scores[hits]
+    if max_bm25 > 0:
+        hit_scores = hit_scores / max_bm25
+    keys = [_KEY_PREFIX[source_type] + str(doc_id)
+            for source_type, doc_id in zip(data['source_types'][hits].tolist(), data['ids'][hits].tolist())]
+    return keys, hit_scores
+
+
+def _top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top_k scores, best first; ties keep the lower index first, like heapq.nlargest."""
+    if top_k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if len(scores) > top_k:
+        kth = np.partition(scores, len(scores) - top_k)[len(scores) - top_k]
+        candidates = np.flatnonzero(scores >= kth)
     else:
-        bm25_norm = []
-
-    combined = {}
-
-    # Add note semantic results
-    for result in note_results:
-        key = f"note_{result['id']}"
-        combined[key] = {
-            'text': result['text'],
-            'source_type': 'note',
-            'note_id': str(result['id']),
-            'created_at': str(result['created_at']),
-            'sem': float(result['similarity']),
-            'bm25': 0.0,
-        }
-
-    # Add manual chunk semantic results
-    for result in chunk_results:
-        key = f"chunk_{result['id']}"
-        combined[key] = {
-            'text': result['chunk_text'],
-            'source_type': 'manual',
-            'manual_title': result['manual_title'],
-            'page_number': result.get('page_number'),
-            'section_title': result.get('section_title'),
-            'chunk_type': result.get('chunk_type', 'text'),
-            'sem': float(result['similarity']),
-            'bm25': 0.0,
-        }
-
-    # Merge BM25 scores
-    for idx, score in enumerate(bm25_norm):
-        if idx >= len(_bm25_data['metas']):
-            break
-        meta = _bm25_data['metas'][idx]
-
-        if meta['source_type'] == 'note':
-            key = f"note_{meta['note_id']}"
+        candidates = np.arange(len(scores))
+    return candidates[np.lexsort((candidates, -scores[candidates]))][:top_k]
+
+
+def _hydrate_entries(ranked: list):
+    """Fetch text + metadata for ranked keyword-only entries; drops rows deleted since indexing."""
+    missing = [key for key, entry in ranked if 'text' not in entry]
+    if not missing:
+        return ranked
+
+    note_ids = [int(key[5:]) for key in missing if key.startswith("note_")]
+    chunk_ids = [int(key[6:]) for key in missing if key.startswith("chunk_")]
+    rows = {f"note_{row['id']}": _note_entry(row) for row in get_notes_by_ids(note_ids)}
+    rows.update({f"chunk_{row['id']}": _chunk_entry(row) for row in get_chunks_by_ids(chunk_ids)})
+
+    hydrated = []
+    for key, entry in ranked:
+        if 'text' not in entry:
+            if key not in rows:
+                continue
+            entry = {**rows[key], 'sem': entry['sem'], 'bm25': entry['bm25'], 'score': entry['score']}
+        hydrated.append((key, entry))
+    return hydrated
+
+
+def _hybrid_retrieve_postgres(query: str, top_k: int, alpha: float, machine_id: int = None):
+    """Hybrid ranking done entirely in Postgres; returns [(key, entry)] best-first."""
+    rows = hybrid_search(generate_query_embedding(query), query, top_k=top_k,
+                         alpha=alpha, machine_id=machine_id)
+    ranked = []
+    for row in rows:
+        if row['source_type'] == 'note':
+            key, entry = f"note_{row['id']}", _note_entry(row, float(row['sem']), float(row['kw_norm']))
         else:
-            key = f"chunk_{meta['chunk_id']}"
+            # UNION ALL takes its column names from the notes branch: chunk text arrives as 'text'
+            key, entry = f"chunk_{row['id']}", _chunk_entry({**row, 'chunk_text': row['text']},
+                                                            float(row['sem']), float(row['kw_norm']))
+        entry['score'] = float(row['score'])
+        ranked.append((key, entry))
+    return ranked
 
-        if key in combined:
-            combined[key]['bm25'] = score
-        else:
-            entry = {
-                'text': _bm25_data['docs'][idx],
-                'source_type': meta['source_type'],
-                'sem': 0.0,
-                'bm25': score,
-            }
-            if meta['source_type'] == 'note':
-                entry['note_id'] = meta['note_id']
-                entry['created_at'] = meta['created_at']
-            else:
-                entry['manual_title'] = meta['manual_title']
-                entry['page_number'] = meta.get('page_number')
-                entry['section_title'] = meta.get('section_title')
-                entry['chunk_type'] = meta.get('chunk_type', 'text')
-            combined[key] = entry
-
-    # Compute combined scores
-    for v in combined.values():
-        v['score'] = alpha * v['sem'] + (1 - alpha) * v['bm25']
-
-    ranked = sorted(combined.items(), key=lambda kv: kv[1]['score'], reverse=True)[:top_k]
+
+def hybrid_retrieve(query: str, top_k: int = 5, alpha: float = 0.6, machine_id: int = None):
+    """Retrieve documents using hybrid BM25 + vector similarity from both notes and manual chunks."""
+    if KEYWORD_BACKEND == "postgres":
+        ranked = _hybrid_retrieve_postgres(query, top_k, alpha, machine_id)
+    else:
+        ranked = _hybrid_retrieve_bm25(query, top_k, alpha, machine_id)
 
     if not ranked:
         return [], [], {"reason": "No documents available"}
@@ -184,3 +600,41 @@ def hybrid_retrieve(query: str, top_k: int = 5, alpha: float = 0.6, machine_id:
     top_metas = [{'key': k, **v} for k, v in ranked]
 
     return top_docs, top_metas, {'top_scores': [m['score'] for m in top_metas]}
+
+
+def _hybrid_retrieve_bm25(query: str, top_k: int, alpha: float, machine_id: int = None):
+    """pgvector semantic search merged with the in-process BM25 index; returns [(key, entry)]."""
+    bm25_index = get_bm25_index(machine_id)
+
+    query_embedding = generate_query_embedding(query)
+
+    # Semantic search across both sources, one round trip
+    semantic_rows = search_similar_union(query_embedding, top_k=top_k * 2, machine_id=machine_id)
+
+    # One slot per candidate: the semantic hits (in result order), then keyword-only matches
+    semantic = [(f"note_{row['id']}", _note_entry, row) if row['source_type'] == 'note'
+                else (f"chunk_{row['id']}", _chunk_entry, row)
+                for row in semantic_rows]
+    slots = {key: i for i, (key, _, _) in enumerate(semantic)}
+    bm25_keys, bm25_scores = _bm25_matches(bm25_index, query)
+    for key in bm25_keys:
+        slots.setdefault(key, len(slots))
+
+    sem = np.zeros(len(slots))
+    sem[:len(semantic)] = [float(row['similarity']) for _, _, row in semantic]
+    bm25 = np.zeros(len(slots))
+    bm25[[slots[key] for key in bm25_keys]] = bm25_scores
+    combined = alpha * sem + (1 - alpha) * bm25
+
+    # Entries are built only for the kept top_k; keyword-only ones are hydrated from the DB
+    keys = list(slots)
+    ranked = []
+    for i in _top_k_indices(combined, top_k).tolist():
+        if i < len(semantic):
+            key, make_entry, row = semantic[i]
+            entry = make_entry(row, sem=float(sem[i]), bm25=float(bm25[i]))
+        else:
+            key, entry = keys[i], {'sem': 0.0, 'bm25': float(bm25[i])}
+        entry['score'] = float(combined[i])
+        ranked.append((key, entry))
+    return _hydrate_entries(ranked)
@@ -0,0 +1,101 @@
+"""
+Export all-MiniLM-L6-v2 to ONNX (optionally dynamic-INT8 quantized) for the ONNX Runtime embedder.
+
+Reads the local PyTorch model in backend/models/all-MiniLM-L6-v2 and writes
+backend/models/all-MiniLM-L6-v2-onnx/{model.onnx, model_quantized.onnx, tokenizer.json, ...}.
+rag.vector_store.get_embedder picks the export up automatically on the next start
+(model_quantized.onnx first) and falls back to PyTorch when the directory is absent.
+
+Needs the build-time extra: pip install "optimum[onnxruntime]"
+
+    cd backend
+    python -m scripts.export_onnx                  # export + quantize for this CPU
+    python -m scripts.export_onnx --no-quantize    # FP32 export only
+    python -m scripts.export_onnx --arch avx2      # quantize for a different target CPU
+"""
+
+import sys
+import argparse
+import platform
+from pathlib import Path
+
+backend_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(backend_dir))
+
+from rag.vector_store import MODELS_DIR, ONNX_MODEL_DIR
+
+SOURCE_MODEL_DIR = MODELS_DIR / "all-MiniLM-L6-v2"
+
+# AutoQuantizationConfig presets in optimum.onnxruntime
+QUANTIZATION_ARCHS = ("avx512_vnni", "avx512", "avx2", "arm64")
+
+
+def cpu_flags():
+    """Instruction-set flags of this CPU from /proc/cpuinfo (empty set where it doesn't exist)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def default_arch():
+    """Quantization preset for the CPU this runs on."""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "arm64"
+    flags = cpu_flags()
+    if "avx512_vnni" in flags:
+        return "avx512_vnni"
+    if "avx512f" in flags:
+        return "avx512"
+    # Least demanding x86 preset; also the pick when the flags can't be read
+    return "avx2"
+
+
+def export(source_dir: Path, output_dir: Path):
+    """Export the transformer to output_dir/model.onnx alongside its tokenizer files."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    from transformers import AutoTokenizer
+
+    print(f"Exporting {source_dir} -> {output_dir}/model.onnx")
+    model = ORTModelForFeatureExtraction.from_pretrained(str(source_dir), export=True)
+    model.save_pretrained(str(output_dir))
+    # OnnxEmbedder loads tokenizer.json from the same directory
+    AutoTokenizer.from_pretrained(str(source_dir)).save_pretrained(str(output_dir))
+
+
+def quantize(output_dir: Path, arch: str):
+    """Dynamic INT8 quantization of output_dir/model.onnx -> output_dir/model_quantized.onnx."""
+    from optimum.onnxruntime import ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    print(f"Quantizing to INT8 ({arch})")
+    quantizer = ORTQuantizer.from_pretrained(str(output_dir), file_name="model.onnx")
+    qconfig = getattr(AutoQuantizationConfig, arch)(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=str(output_dir), quantization_config=qconfig)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the embedding model to ONNX")
+    parser.add_argument("--no-quantize", action="store_true", help="Skip INT8 quantization")
+    parser.add_argument("--arch", choices=QUANTIZATION_ARCHS, default=default_arch(),
+                        help="Target CPU for the quantized model")
+    args = parser.parse_args()
+
+    if not SOURCE_MODEL_DIR.exists():
+        print(f"ERROR: {SOURCE_MODEL_DIR} not found")
+        sys.exit(1)
+
+    ONNX_MODEL_DIR.mkdir(parents=True, exist_ok=True)
+    export(SOURCE_MODEL_DIR, ONNX_MODEL_DIR)
+    if not args.no_quantize:
+        quantize(ONNX_MODEL_DIR, args.arch)
+
+    print(f"\nDone! ONNX model written to {ONNX_MODEL_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,9 @@ sys.path.insert(0, str(backend_dir))
 from dotenv import load_dotenv
 load_dotenv(backend_dir / ".env")
 
+import logging
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
 from rag.db import init_db, create_machine, create_manual, link_machine_manual, get_db_connection
 from rag.pdf_ingestion import process_pdf
 
@@ -16,8 +16,11 @@ sys.path.insert(0, str(backend_dir))
 from dotenv import load_dotenv
 load_dotenv(backend_dir / ".env")
 
-from rag.db import init_db, save_note, get_db_connection
-from rag.vector_store import generate_embedding, load_bm25_index
+import logging
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+from rag.db import init_db, save_notes_bulk, get_db_connection
+from rag.vector_store import generate_embeddings_batch, load_bm25_index
 
 # Machine name -> list of realistic worker notes
 NOTES = {
@@ -84,7 +87,9 @@ def main():
 
     print(f"Found {len(machine_map)} machines\n")
 
-    total = 0
+    # Collect every note first, then embed them all in one batched encode
+    texts = []
+    groups = []  # (machine_id, start, end) slices of texts
     for machine_name, notes in NOTES.items():
         machine_id = machine_map.get(machine_name)
         if not machine_id:
@@ -92,10 +97,16 @@ def main():
             continue
 
         print(f"  {machine_name} (id={machine_id}): {len(notes)} notes")
-        for note_text in notes:
-            embedding = generate_embedding(note_text)
-            save_note(note_text, embedding, machine_id=machine_id)
-            total += 1
+        groups.append((machine_id, len(texts), len(texts) + len(notes)))
+        texts.extend(notes)
+
+    total = 0
+    if texts:
+        print(f"\nEmbedding {len(texts)} notes...")
+        embeddings = generate_embeddings_batch(texts)
+        for machine_id, start, end in groups:
+            save_notes_bulk(texts[start:end], embeddings[start:end], machine_id=machine_id)
+        total = len(texts)
 
     print(f"\nDone! {total} notes inserted.")
 